@@ -21,7 +21,6 @@ requirements = [
     "arrow",
     "PyYaml",
     "colorlog",
-    "werkzeug",
     "json-rpc",
     "prompt_toolkit",
     "pygments",
@@ -63,7 +62,7 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
         'Topic :: Software Development',
         #'Private :: Do Not Upload',  # hack to force invalid package for upload
     ],
@@ -23,7 +23,6 @@ requirements = [
     "arrow",
     "PyYaml",
     "colorlog",
-    "werkzeug",
     "json-rpc",
     "stackhut-client >= 0.1.1",
 ]
@@ -26,6 +26,23 @@ ERR_INTERNAL = -32603
 ERR_UNKNOWN = -32000
 ERR_INVALID_RESP = -32001
 
+# primitive type names and the python types that satisfy them
+_PRIMITIVES = {
+    "int": (int, "int"),
+    "float": ((float, int), "float"),
+    "bool": (bool, "bool"),
+    "string": (str, "string"),
+}
+# exact element types accepted by the bulk check on primitive arrays, as decoded from JSON
+_ELEM_TYPES = {
+    "int": frozenset([int, bool]),
+    "float": frozenset([float, int, bool]),
+    "bool": frozenset([bool]),
+    "string": frozenset([str]),
+}
+_VALID = (True, None)
+_NULL = (False, "Value cannot be null")
+
 
 def contract_from_file(fname):
     """
@@ -808,6 +825,13 @@ class Contract(object):
                     if k != "type":
                         self.meta[k] = v
 
+        # compile the validators for each function once all the types are known
+        self._checks = {}
+        self._validators = {}
+        for iface in self.interfaces.values():
+            for f in iface.functions.values():
+                f.compile()
+
     def validate_request(self, iface_name, func_name, params):
         """
         Validates that the given params match the expected length and types for this
@@ -889,6 +913,128 @@ class Contract(object):
         else:
             raise RpcException(ERR_INVALID_PARAMS, "Unknown interface: '%s'" % iface_name)
 
+    def validator(self, expected_type, is_array):
+        """
+        Returns a compiled validator for the expected type. The validator takes a single value
+        and returns the same (bool, string) tuple as validate(). Validators are built once and
+        cached on the contract.
+
+        :Parameters:
+          expected_type
+            Type instance to build the validator for
+          is_array
+            If True then the validator requires a list of the expected type
+        """
+        key = (expected_type.type, expected_type.optional, is_array)
+        v = self._validators.get(key)
+        if v is None:
+            v = self._validators[key] = self._compile(self._check(expected_type.type),
+                                                      expected_type.optional, is_array,
+                                                      _ELEM_TYPES.get(expected_type.type))
+        return v
+
+    def _compile(self, check, optional, is_array, elem_types=None):
+        """
+        Wraps a check for non-null scalar values with null and array handling.
+        Arrays of primitives are checked in bulk against elem_types, only walking
+        the elements one by one to find the first offending index
+        """
+        if is_array:
+            type_err = self._type_err
+            if elem_types is not None and optional:
+                elem_types = elem_types | {type(None)}
+
+            def validate_list(val):
+                if val is None:
+                    return _VALID if optional else _NULL
+                if not isinstance(val, list):
+                    return type_err(val, "list")
+                if elem_types is not None and elem_types.issuperset(map(type, val)):
+                    return _VALID
+                for i, v in enumerate(val):
+                    if v is None:
+                        if not optional:
+                            return False, "index %d: %s" % (i, _NULL[1])
+                        continue
+                    ok, msg = check(v)
+                    if not ok:
+                        return False, "index %d: %s" % (i, msg)
+                return _VALID
+            return validate_list
+
+        def validate_val(val):
+            if val is None:
+                return _VALID if optional else _NULL
+            return check(val)
+        return validate_val
+
+    def _check(self, type_name):
+        """
+        Returns the cached check for non-null, non-array values of the named type, building it
+        on first use. Struct fields are flattened across the extends chain and enum values held
+        in a frozenset, so no lookups are needed at validation time.
+        """
+        check = self._checks.get(type_name)
+        if check is not None:
+            return check
+
+        if type_name in _PRIMITIVES:
+            kinds, expected = _PRIMITIVES[type_name]
+            type_err = self._type_err
+
+            def check(val):
+                return _VALID if isinstance(val, kinds) else type_err(val, expected)
+            self._checks[type_name] = check
+
+        elif type_name in self.enums:
+            values = self.enums[type_name].values
+            lookup = frozenset(values)
+
+            def check(val):
+                try:
+                    if val in lookup:
+                        return _VALID
+                except TypeError:
+                    pass
+                return False, "'%s' is not in enum: %s" % (val, str(values))
+            self._checks[type_name] = check
+
+        elif type_name in self.structs:
+            s = self.structs[type_name]
+            fields = {}
+            required = []
+
+            def check(val):
+                if type(val) is not dict:
+                    return False, "%s is not a dict" % (str(val))
+                for k, v in val.items():
+                    field_check = fields.get(k)
+                    if field_check is None:
+                        return False, "field '%s' not found in struct %s" % (k, type_name)
+                    ok, msg = field_check(v)
+                    if not ok:
+                        return False, "field '%s': %s" % (k, msg)
+                for name in required:
+                    if name not in val:
+                        return False, "field '%s' missing from: %s" % (name, str(val))
+                return _VALID
+
+            # cache before resolving the fields so recursive structs find themselves
+            self._checks[type_name] = check
+            for f in s.get_all_fields([]):
+                if f.name not in fields:
+                    field = s.field(f.name)
+                    fields[f.name] = self.validator(field, field.is_array)
+                if not f.optional and f.name not in required:
+                    required.append(f.name)
+
+        else:
+            # unknown types and interfaces fail as before, when a value is validated
+            def check(val):
+                return self.get(type_name).validate(val)
+
+        return check
+
     def validate(self, expected_type, is_array, val):
         """
         Validates that the expected type matches the value
@@ -906,34 +1052,7 @@ class Contract(object):
           val
             Value to validate against the expected type
         """
-        if val is None:
-            if expected_type.optional:
-                return True, None
-            else:
-                return False, "Value cannot be null"
-        elif is_array:
-            if not isinstance(val, list):
-                return self._type_err(val, "list")
-            else:
-                for v in val:
-                    ok, msg = self.validate(expected_type, False, v)
-                    if not ok:
-                        return ok, msg
-        elif expected_type.type == "int":
-            if not isinstance(val, int):
-                return self._type_err(val, "int")
-        elif expected_type.type == "float":
-            if not isinstance(val, (float, int)):
-                return self._type_err(val, "float")
-        elif expected_type.type == "bool":
-            if not isinstance(val, bool):
-                return self._type_err(val, "bool")
-        elif expected_type.type == "string":
-            if not isinstance(val, str):
-                return self._type_err(val, "string")
-        else:
-            return self.get(expected_type.type).validate(val)
-        return True, None
+        return self.validator(expected_type, is_array)(val)
 
     def _type_err(self, val, expected):
         return False, "'%s' is of type %s, expected %s" % (val, type(val), expected)
@@ -1068,24 +1187,7 @@ class Struct(object):
           val
             Value to validate.  Must be a dict
         """
-        if type(val) is not dict:
-            return False, "%s is not a dict" % (str(val))
-
-        for k, v in list(val.items()):
-            field = self.field(k)
-            if field:
-                ok, msg = self.contract.validate(field, field.is_array, v)
-                if not ok:
-                    return False, "field '%s': %s" % (field.name, msg)
-            else:
-                return False, "field '%s' not found in struct %s" % (k, self.name)
-
-        all_fields = self.get_all_fields([])
-        for field in all_fields:
-            if field.name not in val and not field.optional:
-                return False, "field '%s' missing from: %s" % (field.name, str(val))
-
-        return True, None
+        return self.contract._check(self.name)(val)
 
     def get_all_fields(self, arr):
         """
@@ -1130,6 +1232,14 @@ class Function(object):
 
         self.validate_structure()
 
+    def compile(self):
+        """
+        Builds the validators for the params and return type, called by the Contract once
+        all the types the function refers to have been loaded
+        """
+        self._param_checks = [(p, self.contract.validator(p, p.is_array)) for p in self.params]
+        self._returns_check = self.contract.validator(self.returns, self.returns.is_array)
+
     def validate_structure(self):
         """
         Sanity check of own properties. Raises InvaildFunctionErrors.
@@ -1160,37 +1270,24 @@ class Function(object):
                 raise RpcException(ERR_INVALID_PARAMS, msg)
 
             # compare each expected and given param
-            [self._validate_param(x, y) for (x, y) in zip(self.params, params)]
+            for ((expected, check), param) in zip(self._param_checks, params):
+                ok, msg = check(param)
+                if not ok:
+                    vals = (self.full_name, expected.name, msg)
+                    msg = "Function '%s' invalid param '%s'. %s" % vals
+                    raise RpcException(ERR_INVALID_PARAMS, msg)
 
     def validate_response(self, resp):
         """
         Validates resp against expected return type for this function.
         Raises RpcException if the response is invalid.
         """
-        ok, msg = self.contract.validate(self.returns,
-                                         self.returns.is_array, resp)
+        ok, msg = self._returns_check(resp)
         if not ok:
             vals = (self.full_name, str(resp), msg)
             msg = "Function '%s' invalid response: '%s'. %s" % vals
             raise RpcException(ERR_INVALID_RESP, msg)
 
-    def _validate_param(self, expected, param):
-        """
-        Validates a single param against its expected type.
-        Raises RpcException if the param is invalid
-
-        :Parameters:
-          expected
-            Type instance
-          param
-            Parameter value to validate
-        """
-        ok, msg = self.contract.validate(expected, expected.is_array, param)
-        if not ok:
-            vals = (self.full_name, expected.name, msg)
-            msg = "Function '%s' invalid param '%s'. %s" % vals
-            raise RpcException(ERR_INVALID_PARAMS, msg)
-
 
 class Type(object):
     def __init__(self, type_dict):
@@ -135,6 +135,24 @@ class HutfileCfg:
         self.dirs = [d for d in files if os.path.isdir(d)]
 
         self.persistent = hutfile.get('persistent', True)
+        self.workers = hutfile.get('workers', 1)
+        self.assert_valid_workers(self.workers)
+        self.concurrency = hutfile.get('concurrency', 1)
+        self.assert_valid_concurrency(self.concurrency)
+        self.prefork = hutfile.get('prefork', False)
+        self.assert_valid_prefork(self.prefork)
+        self.timeout = hutfile.get('timeout', None)
+        self.assert_valid_timeout(self.timeout)
+        self.timeouts = hutfile.get('timeouts', {})
+        self.assert_valid_timeouts(self.timeouts)
+        self.validate_responses = hutfile.get('validate_responses', 'always')
+        self.assert_valid_validation(self.validate_responses)
+        self.download_cache = hutfile.get('download_cache', 0)
+        self.assert_valid_cache_size(self.download_cache)
+        self.trace = hutfile.get('trace', None)
+        self.assert_valid_trace(self.trace)
+        self.log_payloads = hutfile.get('log_payloads', 'summary')
+        self.assert_valid_log_payloads(self.log_payloads)
         self.private = hutfile.get('private', False)
 
         self.os_deps = hutfile.get('os_deps', [])
@@ -147,6 +165,57 @@ class HutfileCfg:
         if HutfileCfg.re_check_name.match(name) is None:
             raise AssertionError("'{}' is not a valid service name, must be [a-z0-9-_]".format(name))
 
+    @staticmethod
+    def assert_valid_workers(workers):
+        if type(workers) is not int or workers < 1:
+            raise AssertionError("'{}' is not a valid worker count, must be a positive integer".format(workers))
+
+    @staticmethod
+    def assert_valid_concurrency(concurrency):
+        if type(concurrency) is not int or concurrency < 1:
+            raise AssertionError("'{}' is not a valid concurrency, must be a positive integer".format(concurrency))
+
+    @staticmethod
+    def assert_valid_prefork(prefork):
+        if type(prefork) is not bool:
+            raise AssertionError("'{}' is not a valid prefork setting, must be true or false".format(prefork))
+
+    @staticmethod
+    def assert_valid_timeout(timeout):
+        if timeout is not None and (type(timeout) not in (int, float) or timeout <= 0):
+            raise AssertionError("'{}' is not a valid timeout, must be a positive number of seconds".format(timeout))
+
+    @staticmethod
+    def assert_valid_timeouts(timeouts):
+        if type(timeouts) is not dict:
+            raise AssertionError("'{}' is not a valid set of timeouts, must map functions to seconds".format(timeouts))
+        for timeout in timeouts.values():
+            HutfileCfg.assert_valid_timeout(timeout)
+
+    @staticmethod
+    def assert_valid_validation(mode):
+        if mode in ('always', 'dev'):
+            return
+        if type(mode) not in (int, float) or not 0 <= mode <= 1:
+            raise AssertionError("'{}' is not a valid response validation mode, must be 'always', 'dev' "
+                                 "or a fraction between 0 and 1".format(mode))
+
+    @staticmethod
+    def assert_valid_cache_size(size):
+        if type(size) is not int or size < 0:
+            raise AssertionError("'{}' is not a valid download cache size, must be a number of MB".format(size))
+
+    @staticmethod
+    def assert_valid_trace(fname):
+        if fname is not None and (type(fname) is not str or not fname):
+            raise AssertionError("'{}' is not a valid trace file, must be a filename".format(fname))
+
+    @staticmethod
+    def assert_valid_log_payloads(mode):
+        if mode not in ['summary', 'full'] and (type(mode) is not int or mode <= 0):
+            raise AssertionError("'{}' is not a valid payload logging mode, must be 'summary', 'full', "
+                                 "or a number of characters".format(mode))
+
     @property
     def from_image(self):
         return "{}-{}".format(self.baseos, self.stack)
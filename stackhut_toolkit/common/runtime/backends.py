@@ -17,31 +17,89 @@ StackHut IO Handling on local and cloud backends
 import abc
 import os
 import json
+import fcntl
+import time
+import uuid
 import shutil
+import asyncio
 import threading
-from queue import Queue
+from http import HTTPStatus
+from queue import Queue, Full
+from contextlib import contextmanager
+from concurrent.futures import Future
 
 import sh
-from werkzeug.wrappers import Request, Response
-from werkzeug.serving import run_simple
-from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import HTTPException, NotFound, ImATeapot
-from werkzeug.utils import redirect
 
-from ..utils import log
-from . import rpc
+from ..utils import log, Payload
+from . import rpc, metrics, codec
+from .tracing import tracer, NULL_TRACE
 
 STACKHUT_DIR = os.path.abspath('.stackhut')
 
+# read sizes used when moving file contents
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# linux ioctl to reflink one file into another
+FICLONE = 0x40049409
+# request dirs waiting on background removal before they are removed inline
+REAPER_QUOTA = 256
+# status line of the unimplemented /files endpoint, HTTPStatus only has it from Python 3.9
+IM_A_TEAPOT = (418, "I'm a teapot")
+
 def get_req_dir(req_id):
     return os.path.join(STACKHUT_DIR, req_id)
 
 def get_req_file(req_id, fname):
     return os.path.join(STACKHUT_DIR, req_id, fname)
 
+def new_req_file(req_id, fname):
+    """Path to write a file into the request dir, which is only created when first needed"""
+    req_fname = get_req_file(req_id, fname)
+    os.makedirs(os.path.dirname(req_fname), exist_ok=True)
+    return req_fname
+
+def chunk_size(length=None):
+    """Pick a read size for a stream of the given length, aiming for a few dozen reads"""
+    if not length:
+        return MIN_CHUNK
+    return max(MIN_CHUNK, min(MAX_CHUNK, int(length) // 32))
+
+def transfer_file(src, dst):
+    """
+    Place the contents of src at dst, avoiding copying the data where possible.
+    Hard-links within a filesystem, else tries a reflink, then an in-kernel copy
+    """
+    os.remove(dst) if os.path.lexists(dst) else None
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            try:
+                offset, size = 0, os.fstat(fsrc.fileno()).st_size
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, MAX_CHUNK)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                # sendfile to a regular file is unsupported on this platform
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, MAX_CHUNK)
+    shutil.copymode(src, dst)
+    return dst
+
 def http_status_code(data):
     if type(data) == list:
-        log.debug("Shit, HTTP status code incorrect")
+        # batch responses carry their errors per-item
+        return 200
 
     if 'error' not in data.get('response', {}):
         return 200
@@ -55,48 +113,155 @@ def http_status_code(data):
     else:
         return 500
 
+class ResponseRegistry:
+    """
+    The requests in flight on a backend, keyed by the task id assigned in _process_request
+    Each task has a Future completed with its response, so many tasks may be running at once
+    and every caller is handed its own response whatever order they finish in
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.sub_reqs = {}
+
+    def register(self, task_req, trace=NULL_TRACE):
+        task_id = task_req['id']
+        with self.lock:
+            response = self.tasks[task_id] = (task_req, Future(), time.monotonic(), trace)
+        return response[1]
+
+    def complete(self, task_id, data):
+        with self.lock:
+            task_req, response, _, _ = self.tasks.pop(task_id, (None, None, None, None))
+        if response is None:
+            log.warn("Response for unknown request {}".format(task_id))
+        else:
+            response.set_result(data)
+
+    @contextmanager
+    def bind(self, req_id, task_id):
+        """Associate a shim sub-request with its task for the duration of the block"""
+        with self.lock:
+            self.sub_reqs[req_id] = task_id
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.sub_reqs.pop(req_id, None)
+
+    def task(self, req_id):
+        """Return the task for the given task or sub-request id, or an empty dict"""
+        with self.lock:
+            task_id = self.sub_reqs.get(req_id, req_id)
+            return self.tasks.get(task_id, ({}, None, None, None))[0]
+
+    def age(self, task_id):
+        """Seconds since the task was registered"""
+        with self.lock:
+            registered = self.tasks.get(task_id, (None, None, None, None))[2]
+        return 0.0 if registered is None else time.monotonic() - registered
+
+    def trace(self, task_id):
+        with self.lock:
+            return self.tasks.get(task_id, (None, None, None, NULL_TRACE))[3]
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+class DirReaper(threading.Thread):
+    """
+    Removes finished request dirs in the background, keeping rmtree off the request path.
+    Once quota dirs are waiting, further dirs are removed inline to bound the space held
+    """
+    def __init__(self, quota=REAPER_QUOTA):
+        super().__init__(daemon=True)
+        self.q = Queue(quota)
+        self.start()
+
+    def run(self):
+        while True:
+            path = self.q.get()
+            if path is None:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+
+    def reap(self, path):
+        # move the dir aside first, a later request reusing the id may create it again before it is removed
+        tombstone = os.path.join(os.path.dirname(path), '.reap-{}'.format(uuid.uuid4().hex))
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            # most requests never create their dir
+            return
+        try:
+            self.q.put_nowait(tombstone)
+        except Full:
+            shutil.rmtree(tombstone, ignore_errors=True)
+
+    def stop(self):
+        """Remove any remaining dirs and finish"""
+        self.q.put(None)
+        self.join()
+
+
 class AbstractBackend:
     """A base wrapper wrapper around common IO task state"""
+    # running locally during development of the service
+    dev = False
+
     def __init__(self, hutcfg, author):
         self.author = author
         self.service_short_name = hutcfg.service_short_name(self.author)
         os.mkdir(STACKHUT_DIR) if not os.path.exists(STACKHUT_DIR) else None
-        self.request = {}
+        self.tasks = ResponseRegistry()
+        self.reaper = DirReaper()
+        # resolved once every shim worker has started up and requests may be served
+        self.ready = Future()
         log.debug("Starting service {}".format(self.service_short_name))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.reaper.stop()
 
     # Interace between backend and runner
     @abc.abstractmethod
     def get_request(self):
         pass
 
-    @abc.abstractmethod
-    def put_response(self, s):
-        pass
+    def put_response(self, task_id, data):
+        self.tasks.complete(task_id, data)
+
+    def set_ready(self):
+        log.info("Service ready")
+        self.ready.set_result(True)
 
     # First-stage processing of request/response
-    def _process_request(self, data):
+    def _process_request(self, data, trace=NULL_TRACE):
+        """Decode and register a new task, returning the task and a Future for its response"""
         try:
-            self.request = json.loads(data.decode('utf-8'))
-            rpc.add_get_id(self.request)
-            log.info("Request - {}".format(self.request))
-            if ((self.request['service'] != self.service_short_name) and ((self.request['service']+':latest') != self.service_short_name)):
-                log.warn("Service request ({}) sent to wrong service ({})".format(self.request['service'], self.service_short_name))
+            task_req = codec.loads(data)
+            # tasks are tracked by an id of our own, as clients may reuse theirs while one is in flight
+            task_req['client_id'] = task_req.get('id')
+            task_req['id'] = str(uuid.uuid4())
+            log.info("Request %s (client id %s) - %s", task_req['id'], task_req['client_id'], Payload(data))
+            if ((task_req['service'] != self.service_short_name) and ((task_req['service']+':latest') != self.service_short_name)):
+                log.warn("Service request ({}) sent to wrong service ({})".format(task_req['service'], self.service_short_name))
+            response = self.tasks.register(task_req, trace)
+        except rpc.RpcException as e:
+            return True, rpc.exc_to_json_error(e), None
         except Exception as e:
             _e = rpc.exc_to_json_error(rpc.ParseError(dict(exception=repr(e))))
-            return True, _e
+            return True, _e, None
         else:
-            return False, self.request
+            return False, task_req, response
 
     def _process_response(self, data):
-        log.info("Response - {}".format(data))
-        self.request = {}
-        return json.dumps(data).encode('utf-8')
+        resp = codec.dumps(data)
+        log.info("Response - %s", Payload(resp))
+        return resp
 
     def get_file(self, key):
         raise NotImplementedError("IOStore.get_file called")
@@ -105,85 +270,195 @@ class AbstractBackend:
     def put_file(self, fname, req_id='', make_public=False):
         pass
 
-    @property
-    def task_id(self):
-        return self.request.get('id', None)
-
-    def create_request_dir(self, req_id):
-        # create a private working dir
-        req_path = os.path.join(STACKHUT_DIR, req_id)
-        os.mkdir(req_path) if not os.path.exists(req_path) else None
-        return req_path
+    def get_task(self, req_id):
+        return self.tasks.task(req_id)
 
     def del_request_dir(self, req_id):
-        req_path = os.path.join(STACKHUT_DIR, req_id)
-        shutil.rmtree(req_path, ignore_errors=True)
+        # the private working dir is created on demand by the shim or runtime helpers
+        self.reaper.reap(get_req_dir(req_id))
+
+
+async def read_http_request(reader):
+    """
+    Read a single HTTP/1.x request from the stream
+    Returns a (method, path, version, headers) tuple, or None if the client closed the connection
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, version = request_line.decode('latin-1').split()
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+
+    return method, target.split('?')[0], version, headers
+
+
+async def read_http_body(reader, headers):
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # skip any trailers, up to the blank line ending the body
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunk = await reader.readexactly(size + 2)
+            chunks.append(chunk[:-2])
+        return b''.join(chunks)
+    else:
+        return await reader.readexactly(int(headers.get('content-length', 0)))
+
+
+def render_http_response(status, body, keep_alive, mimetype='application/json'):
+    """Render the response to send, status being an HTTPStatus or a (code, phrase) pair"""
+    (code, phrase) = status if isinstance(status, tuple) else (status.value, status.phrase)
+    head = ["HTTP/1.1 {} {}".format(code, phrase),
+            "Content-Type: {}".format(mimetype),
+            "Content-Length: {}".format(len(body)),
+            "Connection: {}".format('keep-alive' if keep_alive else 'close')]
+    return '\r\n'.join(head).encode('latin-1') + b'\r\n\r\n' + body
 
 
 class LocalRequestServer(threading.Thread):
-    def __init__(self, port, backend, req_q, resp_q):
+    """
+    Local asyncio HTTP server running on a separate thread for dev usage
+    Accepts many concurrent keep-alive connections, feeding run requests to the
+    LocalBackend over a bounded work queue and waiting on a future per request id
+    Connections are accepted straight away so /health and /ready can be polled,
+    while run requests are held back until the service is ready
+    """
+    def __init__(self, port, backend, req_q):
         super().__init__(daemon=True)
         # configure the local server thread
         self.port = port
         self.req_q = req_q
-        self.resp_q = resp_q
         self.backend = backend
-        # self.got_req = threading.Event()
-        self.start()
+        self.loop = asyncio.new_event_loop()
+        self.slots = None
 
         # routing
-        self.url_map = Map([
-            Rule('/run', endpoint='run_request'),
-            Rule('/files', endpoint='run_files'),
-        ])
+        self.url_map = {
+            '/run': self.on_run_request,
+            '/files': self.on_run_files,
+            '/health': self.on_health,
+            '/ready': self.on_ready,
+            '/metrics': self.on_metrics,
+        }
+        self.mimetypes = {
+            '/metrics': metrics.CONTENT_TYPE,
+        }
+        self.start()
 
     def run(self):
         # start in a new thread
+        asyncio.set_event_loop(self.loop)
+        # requests waiting on a slot hold back their connection, pushing back on the client
+        self.slots = asyncio.Semaphore(self.req_q.maxsize)
+        server = self.loop.run_until_complete(asyncio.start_server(self.local_server, '0.0.0.0', self.port))
         log.info("Started StackHut Request Server - press Ctrl-C to quit")
-        run_simple('0.0.0.0', self.port, self.local_server)
-
-    @Request.application
-    def local_server(self, request):
-        """
-        Local webserver running on separate thread for dev usage
-        Sends msgs to LocalBackend over a pair of shared queues
-        """
-        adapter = self.url_map.bind_to_environ(request.environ)
+        self.loop.run_forever()
+
+        # once stopped, drop any open client connections
+        server.close()
+        # asyncio.all_tasks is only available from Python 3.7
+        tasks = (asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks)(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+    async def local_server(self, reader, writer):
+        """Serve HTTP requests on a single (keep-alive) client connection"""
         try:
-            endpoint, values = adapter.match()
-            return getattr(self, 'on_' + endpoint)(request, **values)
-        except HTTPException as e:
-            return e
-
-    def on_run_request(self, request):
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                method, path, version, headers = request
+
+                if headers.get('expect', '').lower() == '100-continue':
+                    writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                trace = tracer.begin(headers)
+                with trace.span('http_receive'):
+                    body = await read_http_body(reader, headers)
+
+                endpoint = self.url_map.get(path)
+                if endpoint is None:
+                    status, data = HTTPStatus.NOT_FOUND, b''
+                else:
+                    status, data = await endpoint(body, trace)
+
+                conn_hdr = headers.get('connection', '').lower()
+                keep_alive = (conn_hdr != 'close') if version == 'HTTP/1.1' else (conn_hdr == 'keep-alive')
+                mimetype = self.mimetypes.get(path, 'application/json')
+                writer.write(render_http_response(status, data, keep_alive, mimetype))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            log.debug("Closing client connection - {}".format(repr(e)))
+        finally:
+            writer.close()
+
+    async def on_run_request(self, body, trace):
         """
-        Sends run requests to LocalBackend over a pair of shared queues
+        Sends run requests to LocalBackend, waiting for the response registered for the task
         """
-        (rpc_error, data) = self.backend._process_request(request.data)
+        with trace.span('decode'):
+            (rpc_error, data, response) = self.backend._process_request(body, trace)
         if rpc_error:
             return self.return_reponse(data)
 
         task_req = data
-        self.req_q.put(task_req)
-        response = self.resp_q.get()
-
-        self.req_q.task_done()
-        self.resp_q.task_done()
-
-        return self.return_reponse(response)
+        await asyncio.wrap_future(self.backend.ready, loop=self.loop)
+        async with self.slots:
+            self.req_q.put_nowait(task_req)
+            data = await asyncio.wrap_future(response, loop=self.loop)
+
+        start = time.monotonic()
+        resp = self.return_reponse(data)
+        end = time.monotonic()
+        method = metrics.method_label(task_req.get('request'))
+        metrics.latency.observe(end - start, method=method, phase='serialization')
+        trace.add('encode', start, end)
+        tracer.finish(trace, method)
+        return resp
 
     def return_reponse(self, data):
-        return Response(self.backend._process_response(data),
-                        status=http_status_code(data), mimetype='application/json')
+        return HTTPStatus(http_status_code(data)), self.backend._process_response(data)
 
-    def on_run_files(self, request):
+    async def on_run_files(self, body, trace):
         log.debug("In run_files endpoint")
-        raise ImATeapot()
+        return IM_A_TEAPOT, b''
+
+    async def on_health(self, body, trace):
+        """The server is up, whether or not the service is ready"""
+        return HTTPStatus.OK, json.dumps(dict(status='ok')).encode('utf-8')
+
+    async def on_metrics(self, body, trace):
+        return HTTPStatus.OK, metrics.registry.render().encode('utf-8')
 
+    async def on_ready(self, body, trace):
+        """The service has started up and is serving requests"""
+        ready = self.backend.ready.done()
+        status = HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE
+        return status, json.dumps(dict(ready=ready)).encode('utf-8')
 
 
 class LocalBackend(AbstractBackend):
     """Mock storage and server system for local testing"""
+    dev = True
     local_store = "run_result"
 
     def _get_path(self, name):
@@ -198,16 +473,14 @@ class LocalBackend(AbstractBackend):
         if not os.path.exists(self.local_store):
             os.mkdir(self.local_store)
 
-        # configure the local server thread
-        self.req_q = Queue(1)
-        self.resp_q = Queue(1)
-        self.server = LocalRequestServer(port, self, self.req_q, self.resp_q)
+        # configure the local server thread, queueing enough work to keep every shim slot busy
+        self.req_q = Queue(2 * hutcfg.workers * hutcfg.concurrency)
+        self.server = LocalRequestServer(port, self, self.req_q)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         log.debug("Shutting down Local backend")
-        # wait for queues to empty
-        self.req_q.join()
-        self.resp_q.join()
+        self.server.stop()
+        super().__exit__(exc_type, exc_val, exc_tb)
 
         # change the results owner
         if self.uid_gid is not None:
@@ -216,8 +489,9 @@ class LocalBackend(AbstractBackend):
     def get_request(self):
         return self.req_q.get()
 
-    def put_response(self, data):
-        self.resp_q.put(data)
+    def put_response(self, task_id, data):
+        self.req_q.task_done()
+        super().put_response(task_id, data)
 
     def _process_response(self, _data):
         """For local wrap up in a response dict"""
@@ -234,5 +508,4 @@ class LocalBackend(AbstractBackend):
         local_store_dir = self._get_path(req_id)
 
         os.mkdir(local_store_dir) if not os.path.exists(local_store_dir) else None
-        shutil.copy(req_fname, local_store_dir)
-        return os.path.join(local_store_dir, fname)
+        return transfer_file(req_fname, os.path.join(local_store_dir, os.path.basename(fname)))
@@ -0,0 +1,167 @@
+# Copyright 2015 StackHut Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+JSON codec used on the request path, using the fastest JSON library installed
+Run as a module to benchmark the codec cost of a request with each library, i.e.
+python3 -m stackhut_toolkit.common.runtime.codec
+"""
+import json
+import math
+import uuid
+
+# the fast libraries parse integers too large for 64 bits as floats, so leave any run of 19 digits, which may be
+# below -2**63, to the stdlib - found by mapping digits to 0 and all else to a space, much quicker than a regex
+DIGITS = bytes(ord('0') if chr(b) in '0123456789' else ord(' ') for b in range(256))
+LONG_INT = b'0' * 19
+# stands in for raw JSON while the object holding it is encoded
+RAW_MARK = 'raw-' + uuid.uuid4().hex + '-{}'
+
+
+def _std_dumps(obj, default=None):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=default).encode('utf-8')
+
+
+def _std_loads(data):
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+
+
+def _non_finite(obj):
+    """Whether obj holds a NaN or infinite float"""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_non_finite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_non_finite(v) for v in obj)
+    return False
+
+
+# available libraries, fastest first, each as a dumps to bytes and a loads from bytes or str
+codecs = {}
+try:
+    import orjson
+
+    def _orjson_dumps(obj, default=None):
+        data = orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+        # orjson writes NaN and Infinity as null, so only search the object for them when there's a null
+        if b'null' in data and _non_finite(obj):
+            raise ValueError("NaN or Infinity in {}".format(type(obj)))
+        return data
+
+    codecs['orjson'] = (_orjson_dumps, orjson.loads)
+except ImportError:
+    pass
+try:
+    import ujson
+    codecs['ujson'] = (lambda obj, default=None: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False,
+                                                             default=default).encode('utf-8'),
+                       ujson.loads)
+except ImportError:
+    pass
+codecs['json'] = (_std_dumps, _std_loads)
+
+name = None
+_dumps = _loads = None
+
+
+def use(codec_name):
+    """Switch to the named JSON library"""
+    global name, _dumps, _loads
+    _dumps, _loads = codecs[codec_name]
+    name = codec_name
+
+
+use(next(iter(codecs)))
+
+
+class Raw:
+    """Already encoded JSON, embedded as-is when encoding the object holding it"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        return "Raw({})".format(self.data)
+
+
+def dumps(obj):
+    """Encode obj as compact UTF-8 JSON bytes"""
+    raws = []
+
+    def default(o):
+        if isinstance(o, Raw):
+            raws.append(o.data)
+            return RAW_MARK.format(len(raws) - 1)
+        raise TypeError("{} is not JSON serializable".format(repr(o)))
+
+    try:
+        data = _dumps(obj, default)
+    except (TypeError, OverflowError, ValueError):
+        # e.g. integers too large for the fast libraries, or NaN and Infinity which they write as null or reject
+        raws.clear()
+        data = _std_dumps(obj, default)
+
+    for i, raw in enumerate(raws):
+        data = data.replace('"{}"'.format(RAW_MARK.format(i)).encode('utf-8'), raw, 1)
+    return data
+
+
+def loads(data):
+    """Decode JSON from bytes or str"""
+    if _loads is not _std_loads:
+        if LONG_INT not in (data if isinstance(data, bytes) else data.encode('utf-8')).translate(DIGITS):
+            try:
+                return _loads(data)
+            except ValueError:
+                # e.g. NaN, Infinity or 1e400, which the stdlib writes and reads
+                pass
+    return _std_loads(data)
+
+
+def _benchmark():
+    import timeit
+
+    # a task request and the shim response for it, with small and large params/results
+    payloads = [('small', [1, 2], 3),
+                ('1k floats', [[i / 7 for i in range(1000)]], [i / 3 for i in range(1000)]),
+                ('100k ints', [list(range(100000))], list(range(100000)))]
+
+    print("Codec cost of a request in ms, from decoding it through encoding its response")
+    print("{:<10}{:<12}{:>10}{:>10}".format('codec', 'payload', 'decoded', 'raw'))
+    for codec_name in codecs:
+        use(codec_name)
+        for (label, params, result) in payloads:
+            task_req = dumps(dict(service='demo', request=dict(method='Default.run', params=params, id='1')))
+            shim_resp = dumps(dict(msg_id=0, result=result))
+            raw_result = shim_resp[len(b'{"msg_id":0,"result":'):-1]
+
+            def decoded():
+                req = loads(task_req)['request']
+                dumps(dict(method=req['method'], params=req['params'], req_id='1-1', msg_id=0))
+                resp = loads(shim_resp)
+                dumps(dict(response=dict(jsonrpc='2.0', id=req['id'], result=resp['result'])))
+
+            def raw():
+                req = loads(task_req)['request']
+                dumps(dict(method=req['method'], params=req['params'], req_id='1-1', msg_id=0))
+                dumps(dict(response=dict(jsonrpc='2.0', id=req['id'], result=Raw(raw_result))))
+
+            n = 2000 if label == 'small' else 20
+            times = [min(timeit.repeat(f, number=n, repeat=3)) / n * 1000 for f in (decoded, raw)]
+            print("{:<10}{:<12}{:>10.3f}{:>10.3f}".format(codec_name, label, *times))
+
+
+if __name__ == '__main__':
+    _benchmark()
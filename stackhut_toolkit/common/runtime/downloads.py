@@ -0,0 +1,351 @@
+# Copyright 2015 StackHut Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Asynchronous file downloads for the runtime helpers
+"""
+import os
+import ssl
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import parsedate
+from urllib.parse import urlsplit, urljoin
+
+from ..utils import log
+from .backends import chunk_size, transfer_file
+
+# downloads in flight at once for the service
+CONCURRENCY = 8
+# attempts at each transfer, every retry resuming from where the last stopped
+RETRIES = 3
+# seconds to wait on the remote server
+TIMEOUT = 60
+MAX_REDIRECTS = 5
+# in parallel mode, files at least this large are split into ranges fetched side by side
+PARALLEL_PARTS = 4
+MIN_PARALLEL_SIZE = 16 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+async def read_http_response(reader):
+    """Read the status line and headers of an HTTP/1.x response, returning (status, headers)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Server closed the connection")
+    status = int(status_line.decode('latin-1').split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+
+    return status, headers
+
+
+async def copy_http_body(reader, headers, size, write):
+    """Pass the body of a response to write in chunks of up to size bytes"""
+    async def copy_exactly(n):
+        while n > 0:
+            data = await asyncio.wait_for(reader.read(min(n, size)), TIMEOUT)
+            if not data:
+                raise asyncio.IncompleteReadError(b'', n)
+            write(data)
+            n -= len(data)
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            n = int((await asyncio.wait_for(reader.readline(), TIMEOUT)).split(b';')[0], 16)
+            if n == 0:
+                break
+            await copy_exactly(n)
+            await reader.readexactly(2)
+    elif 'content-length' in headers:
+        await copy_exactly(int(headers['content-length']))
+    else:
+        # body runs until the server closes the connection
+        while True:
+            data = await asyncio.wait_for(reader.read(size), TIMEOUT)
+            if not data:
+                break
+            write(data)
+
+
+class DownloadCache:
+    """
+    Content-addressed store of downloaded files, keyed by their url and ETag or Last-Modified,
+    evicting the least recently used files once over max_size bytes.
+    Files are hard-linked in and out of the cache, and so are shared with the request dirs
+    Used from the event loop of the downloader, while the stats may be read from any thread
+    """
+    index_file = 'index.json'
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        # url -> dict(key, validator, size), least recently used first
+        self.entries = OrderedDict()
+        # total size of the files held, kept as entries are added and removed
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        index_path = os.path.join(root, self.index_file)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for (url, entry) in json.load(f):
+                    if os.path.exists(self._path(entry['key'])):
+                        self.entries[url] = entry
+                        self.size += entry['size']
+
+        # the index is only saved on a clean exit, so remove any files added since that it doesn't hold
+        keys = {e['key'] for e in self.entries.values()}
+        for fname in os.listdir(root):
+            if fname != self.index_file and fname not in keys:
+                log.debug("Removing unindexed download cache file {}".format(fname))
+                os.remove(self._path(fname))
+
+    @property
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        files=len(self.entries), size=self.size)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, url):
+        """Return the cache entry for url, if any"""
+        return self.entries.get(url)
+
+    def get(self, url, fname):
+        """Place the cached copy of url at fname, returning False if it has been evicted since it was looked up"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return False
+            self.entries.move_to_end(url)
+            self.hits += 1
+        transfer_file(self._path(entry['key']), fname)
+        return True
+
+    def put(self, url, validator, fname):
+        """Add the file downloaded from url into the cache, if it can be revalidated later"""
+        with self.lock:
+            self.misses += 1
+        size = os.path.getsize(fname)
+        if validator is None or size > self.max_size:
+            return
+
+        key = hashlib.sha256('{}\n{}'.format(url, validator).encode('utf-8')).hexdigest()
+        self._remove(url)
+        transfer_file(fname, self._path(key))
+        with self.lock:
+            self.entries[url] = dict(key=key, validator=validator, size=size)
+            self.size += size
+
+        while self.size > self.max_size:
+            self._remove(next(iter(self.entries)))
+            with self.lock:
+                self.evictions += 1
+
+    def _remove(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is None:
+                return
+            self.size -= entry['size']
+        os.remove(self._path(entry['key'])) if os.path.exists(self._path(entry['key'])) else None
+
+    def save(self):
+        with self.lock:
+            entries = list(self.entries.items())
+        with open(os.path.join(self.root, self.index_file), 'w') as f:
+            json.dump(entries, f)
+
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view, offset = view[n:], offset + n
+
+
+class Downloader:
+    """
+    Runs file downloads on an event loop, for the runtime helpers calling from other threads
+    Transfers are streamed to disk in large chunks, limited in the number in flight at once,
+    and resumed with an HTTP Range request when interrupted. Large files may optionally be
+    fetched as several ranges side by side, and files kept in an optional DownloadCache
+    """
+    def __init__(self, loop, concurrency=CONCURRENCY, cache=None):
+        self.loop = loop
+        self.concurrency = concurrency
+        self.cache = cache
+        self.slots = None
+
+    def download(self, url, fname, parallel=False):
+        """Download url into fname, blocking until complete"""
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, fname, parallel), self.loop).result()
+
+    def download_many(self, items, parallel=False):
+        """Download a list of (url, fname) pairs at once, blocking until all are complete"""
+        return asyncio.run_coroutine_threadsafe(self.fetch_many(items, parallel), self.loop).result()
+
+    async def fetch_many(self, items, parallel=False):
+        return await asyncio.gather(*[self.fetch(url, fname, parallel) for (url, fname) in items])
+
+    async def fetch(self, url, fname, parallel=False):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+
+        async with self.slots:
+            entry = self.cache.lookup(url) if self.cache is not None else None
+            # other downloads may evict the entry while it is revalidated
+            if entry is not None and await self._unchanged(url, entry['validator']) and self.cache.get(url, fname):
+                log.debug("Using cached copy of {}".format(url))
+                return fname
+
+            # replace rather than truncate any existing file, it may be linked into the cache
+            os.remove(fname) if os.path.lexists(fname) else None
+            fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                size = (await self._probe(url)) if parallel else 0
+                if size >= MIN_PARALLEL_SIZE:
+                    log.debug("Downloading {} in {} parts".format(url, PARALLEL_PARTS))
+                    os.ftruncate(fd, size)
+                    part = -(-size // PARALLEL_PARTS)
+                    parts = await asyncio.gather(*[self._transfer(url, fd, start, min(start + part, size) - 1)
+                                                   for start in range(0, size, part)])
+                    validator = parts[0][1]
+                else:
+                    (pos, validator) = await self._transfer(url, fd)
+                    os.ftruncate(fd, pos)
+            except BaseException:
+                # don't leave a partial file behind
+                os.remove(fname)
+                raise
+            finally:
+                os.close(fd)
+
+            if self.cache is not None:
+                self.cache.put(url, validator, fname)
+        return fname
+
+    async def _open(self, url, headers):
+        """Send a GET request for url, following redirects, returning (status, headers, reader, writer)"""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            secure = parts.scheme == 'https'
+            port = parts.port or (443 if secure else 80)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, port, ssl=ssl.create_default_context() if secure else None),
+                TIMEOUT)
+
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            head = ["GET {} HTTP/1.1".format(path),
+                    "Host: {}".format(parts.netloc),
+                    "User-Agent: stackhut",
+                    "Accept-Encoding: identity",
+                    "Connection: close"]
+            head.extend("{}: {}".format(k, v) for (k, v) in headers.items())
+            writer.write('\r\n'.join(head).encode('latin-1') + b'\r\n\r\n')
+
+            status, resp_headers = await asyncio.wait_for(read_http_response(reader), TIMEOUT)
+            if status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+                writer.close()
+                url = urljoin(url, resp_headers['location'])
+                continue
+            return status, resp_headers, reader, writer
+
+        raise DownloadError("Too many redirects downloading {}".format(url))
+
+    async def _unchanged(self, url, validator):
+        """Check whether url still matches the validator of a cached copy"""
+        cond = 'If-Modified-Since' if parsedate(validator) else 'If-None-Match'
+        try:
+            status, headers, reader, writer = await self._open(url, {cond: validator, 'Range': 'bytes=0-0'})
+            writer.close()
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            log.debug("Could not revalidate {} - {}".format(url, repr(e)))
+            return False
+        return status == 304
+
+    async def _probe(self, url):
+        """Return the size of url if the server can serve it in ranges, else 0"""
+        try:
+            status, headers, reader, writer = await self._open(url, {'Range': 'bytes=0-0'})
+            writer.close()
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            log.debug("Could not probe {} - {}".format(url, repr(e)))
+            return 0
+        if status != 206 or '/' not in headers.get('content-range', ''):
+            return 0
+        size = headers['content-range'].rsplit('/', 1)[1]
+        return int(size) if size.isdigit() else 0
+
+    async def _transfer(self, url, fd, start=0, end=None):
+        """
+        Write bytes start to end (inclusive, else to the end of the file) of url into fd at the
+        same offsets, resuming with a Range request should the transfer be interrupted.
+        Returns the offset reached and the ETag or Last-Modified of the file, if known
+        """
+        pos, validator, error = start, None, None
+
+        def write(data):
+            nonlocal pos
+            pwrite_all(fd, data, pos)
+            pos += len(data)
+
+        for attempt in range(RETRIES):
+            headers = {}
+            if pos > 0 or end is not None:
+                headers['Range'] = 'bytes={}-{}'.format(pos, '' if end is None else end)
+                if validator:
+                    headers['If-Range'] = validator
+
+            try:
+                status, resp_headers, reader, writer = await self._open(url, headers)
+                try:
+                    if status == 416 and end is None and pos > start:
+                        # already had the whole file when interrupted
+                        return pos, validator
+                    elif status == 200 and 'Range' in headers:
+                        # the server ignored the range, or the file changed - start again
+                        if end is not None:
+                            raise DownloadError("Server does not support ranges for {}".format(url))
+                        pos, validator = start, None
+                    elif status not in (200, 206):
+                        raise DownloadError("Downloading {} returned HTTP {}".format(url, status))
+
+                    validator = validator or resp_headers.get('etag') or resp_headers.get('last-modified')
+                    await copy_http_body(reader, resp_headers, chunk_size(resp_headers.get('content-length')), write)
+                    return pos, validator
+                finally:
+                    writer.close()
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                log.debug("Download of {} interrupted at byte {} - {}".format(url, pos, repr(e)))
+                error = e
+
+        raise DownloadError("Failed downloading {} - {}".format(url, repr(error)))
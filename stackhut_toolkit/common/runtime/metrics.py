@@ -0,0 +1,157 @@
+# Copyright 2015 StackHut Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Service metrics, rendered in the Prometheus text format for the /metrics endpoint
+"""
+import bisect
+import threading
+from collections import defaultdict
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def fmt_labels(labels):
+    if not labels:
+        return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, esc(v)) for (k, v) in labels) + '}'
+
+
+def fmt_value(value):
+    return '+Inf' if value == float('inf') else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values
+    Where fn is given the samples are read from it when rendered, as a dict from label value tuples to values
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labelnames=(), fn=None):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.values = defaultdict(int)
+
+    def _key(self, labels):
+        return tuple(labels[k] for k in self.labelnames)
+
+    def samples(self):
+        """Yield the (name, labels, value) of each sample"""
+        if self.fn is not None:
+            values = self.fn()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend('{}{} {}'.format(name, fmt_labels(labels), fmt_value(value))
+                     for (name, labels, value) in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+        # per label values, the count within each bucket, the overflow, and the sum
+        self.values = defaultdict(lambda: [[0] * (len(self.buckets) + 1), 0.0])
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values[key]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {k: (list(counts), total) for (k, (counts, total)) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels + (('le', fmt_value(float(bound))),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Registry:
+    """The metrics rendered by the /metrics endpoint, by name"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def add(self, metric):
+        """Add or replace the metric of the same name"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(m.render() + '\n' for m in metrics)
+
+
+registry = Registry()
+
+# request metrics, recorded by StackHutRPC and the request server
+requests = registry.add(Counter('stackhut_requests_total', "Requests run, by function", ['method']))
+errors = registry.add(Counter('stackhut_request_errors_total', "Requests failed, by function and JSON-RPC error code",
+                              ['method', 'code']))
+latency = registry.add(Histogram('stackhut_request_phase_seconds', "Time spent in each phase of a request, "
+                                 "where phase is one of validation, queue, shim or serialization", ['method', 'phase']))
+
+# the functions of the service, set from its contract, the only methods given their own label
+methods = set()
+
+
+def method_label(req):
+    """The function a request is for as a metric label, with batches and unknown functions grouped together"""
+    if type(req) is list:
+        return 'batch'
+    method = str(req.get('method', '')) if type(req) is dict else ''
+    method = method if '.' in method else 'Default.' + method
+    return method if method in methods else 'unknown'
@@ -17,19 +17,27 @@ StackHut interface and modifications to Barrister RPC library
 import os
 import json
 import uuid
+import random
+import time
 import signal
+import threading
 from enum import Enum
-import sh
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from concurrent import futures
 
 from ..barrister import err_response, ERR_PARSE, ERR_INVALID_REQ, ERR_METHOD_NOT_FOUND, \
     ERR_INVALID_PARAMS, ERR_INTERNAL, ERR_UNKNOWN, ERR_INVALID_RESP, \
     parse, contract_from_file, RpcException
-from ..utils import log
+from ..utils import log, Payload
+from . import metrics
+from .tracing import NULL_TRACE
+from .workers import WorkerPool, ShimExitError
 
 CONTRACTFILE = '.api.json'
 IDLFILE = 'api.idl'
-REQ_FIFO = '.req.json'
-RESP_FIFO = '.resp.json'
+# seconds allowed for the shutdown hooks of every worker to run
+SHUTDOWN_TIMEOUT = 5
 
 """
 High-level interface into the IDL file
@@ -76,6 +84,7 @@ def generate_contract_file():
 ####################################################################################################
 # Error handling
 ERR_SERVICE = -32002
+ERR_TIMEOUT = -32003
 
 class ParseError(RpcException):
     def __init__(self, data=None):
@@ -106,6 +115,18 @@ class NonZeroExitError(RpcException):
         data = dict(exit_code=exit_code, stderr=stderr)
         super().__init__(-32001, 'Sub-command returned a non-zero exit', data)
 
+class CommandTimeoutError(RpcException):
+    def __init__(self, timeout):
+        super().__init__(ERR_TIMEOUT, 'Sub-command timed out', dict(timeout=timeout))
+
+class WorkerExitError(RpcException):
+    def __init__(self):
+        super().__init__(ERR_INTERNAL, 'Internal Error - Service worker exited while running the request')
+
+class RequestTimeoutError(RpcException):
+    def __init__(self, timeout):
+        super().__init__(ERR_TIMEOUT, 'Request timed out', dict(timeout=timeout))
+
 def exc_to_json_error(e, req_id=None):
     return err_response(req_id, e.code, e.msg, e.data)
 
@@ -132,109 +153,283 @@ class StackHutRPC:
     * passing messages between the runner and shim/client process
     """
 
-    def __init__(self, backend, shim_cmd):
+    def __init__(self, backend, shim_cmd, workers=1, concurrency=1, validate_responses='always', env=None,
+                 prefork=False, timeout=None, timeouts=None):
         self.contract = contract_from_file(CONTRACTFILE)
         self.backend = backend
-
-        # setup fifos
-        os.mkfifo(REQ_FIFO)
-        os.mkfifo(RESP_FIFO)
-
-        # run the shim
-        cmd = sh.Command(shim_cmd[0])
-        self.p = cmd(shim_cmd[1:], _bg=True, _out=lambda x: log.debug("Runner - {}".format(x.rstrip())),
-                     _err=lambda x: log.error("Runner - {}".format(x.rstrip())))
+        # fraction of responses checked against the contract
+        if validate_responses == 'always':
+            self.validate_rate = 1.0
+        elif validate_responses == 'dev':
+            self.validate_rate = 1.0 if backend.dev else 0.0
+        else:
+            self.validate_rate = float(validate_responses)
+        self.validation_stats = Counter(validated=0, skipped=0)
+        self.stats_lock = threading.Lock()
+        # seconds a request may run for before its shim is restarted, overridden per function
+        self.timeout = timeout
+        self.timeouts = {(k if '.' in k else 'Default.' + k): v for (k, v) in (timeouts or {}).items()}
+        # run the shim workers, each starting up whenever it is (re)started
+        self.pool = WorkerPool(shim_cmd, workers, concurrency, env, prefork, self._worker_startup)
+
+        # metrics of the service and its workers, read as they are rendered
+        metrics.methods.update('{}.{}'.format(iface_name, func_name)
+                               for (iface_name, iface) in self.contract.interfaces.items() for func_name in iface.functions)
+        metrics.registry.add(metrics.Gauge('stackhut_requests_in_flight', "Requests received and not yet responded to",
+                                           fn=lambda: {(): len(self.backend.tasks)}))
+        metrics.registry.add(metrics.Gauge('stackhut_worker_requests_in_flight', "Requests running on each shim worker",
+                                           ['worker'], fn=lambda: {(w.idx,): w.inflight for w in self.pool}))
+        metrics.registry.add(metrics.Counter('stackhut_worker_restarts_total', "Shim workers restarted after timing out",
+                                             ['worker'], fn=lambda: {(w.idx,): w.restarts for w in self.pool}))
+        metrics.registry.add(metrics.Counter('stackhut_worker_crashes_total', "Shim workers exited unexpectedly",
+                                             ['worker'], fn=lambda: {(w.idx,): w.crashes for w in self.pool}))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         def handler(signum, frame):
-            log.error("Force-quitting RPC subprocess")
-            self.p.kill()
+            log.error("Force-quitting RPC subprocesses")
+            self.pool.kill()
             raise TimeoutError()
 
-        # Set the signal handler and a 5-second alarm
+        # Set the signal handler and an alarm, should the shutdown still hang
         signal.signal(signal.SIGALRM, handler)
-        signal.alarm(5)
+        signal.alarm(SHUTDOWN_TIMEOUT + 1)
 
-        # send shutdown msg to each iface
+        try:
+            # send shutdown msg to each iface on every worker, within the time allowed for them all
+            deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+            for worker in self.pool:
+                for iface in self.contract.interfaces.keys():
+                    log.debug("Send shutdown to {} on {}".format(iface, worker))
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        log.warn("Could not shutdown {} - out of time".format(worker))
+                        break
+                    try:
+                        self._cmd_call('{}.{}'.format(iface, SHCmds.shutdown.name), worker, timeout)
+                    except (ConnectionError, RpcException) as e:
+                        log.warn("Could not shutdown {} - {}".format(worker, e))
+
+            log.debug("Terminating RPC sub-processes")
+            self.pool.terminate()
+        finally:
+            signal.alarm(0)
+        log.debug("Responses validated {validated}, skipped {skipped}".format(**self.validation_stats))
+        log.debug("Shim workers restarted {} time(s), crashed {} time(s)".format(self.pool.restarts, self.pool.crashes))
+
+    def _worker_startup(self, worker):
+        """Send startup to each iface on a newly started worker"""
         for iface in self.contract.interfaces.keys():
-            log.debug("Send shutdown to {}".format(iface))
-            self._cmd_call('{}.{}'.format(iface, SHCmds.shutdown.name))
-
-        log.debug("Terminating RPC sub-process")
+            log.debug("Send startup to {} on {}".format(iface, worker))
+            try:
+                self._cmd_call('{}.{}'.format(iface, SHCmds.startup.name), worker)
+            except MethodNotFoundError:
+                log.debug("No startup for {} on {}".format(iface, worker))
+
+    def startup(self):
+        """Wait for every worker to start up, any failure stops the service from starting"""
+        for worker in self.pool:
+            worker.ready.wait()
+            if worker.start_error is not None:
+                raise worker.start_error
+
+    def _cmd_call(self, cmd, worker, timeout=None):
+        log.debug('Sending cmd message - {}'.format(cmd))
+        sub_req = dict(method=cmd, params=[], req_id='shcmd-{}'.format(uuid.uuid4().hex))
+        resp = self._sub_call(sub_req, worker, timeout, cmd=True)
+        log.debug("Cmd response - {}".format(resp))
 
-        try:
-            self.p.terminate()
-            self.p.wait()
-        except sh.SignalException_15:
-            log.warn("RPC subprocess shutdown uncleanly")
-            pass
+    def _prepare_req(self, req, req_id, task_id):
+        """
+        Massage and validate a single request
+        Returns the sub-request to send to the shim, or None if already handled
+        """
+        if 'jsonrpc' not in req:
+            req['jsonrpc'] = "2.0"
+        if "method" not in req:
+            raise InvalidReqError(dict(msg="No method"))
+        # return the idl - TODO - move into Scala
+        if req['method'] == "common.barrister-idl" or req['method'] == "getIdl":
+            return None
+        # add the default interface if none exists
+        if req['method'].find('.') < 0:
+            req['method'] = "{}.{}".format('Default', req['method'])
+
+        # NOTE - would setup context and run pre/post filters here in Barrister
+        # Ok, - we're good to go
+        method = req["method"]
+        iface_name, func_name = method.split('.')
+        params = req.get('params', [])
+
+        self.contract.validate_request(iface_name, func_name, params)
+        # client ids are only unique per-client, so qualify them by the task for the shim
+        sub_id = '{}-{}'.format(task_id, req_id)
+        return dict(method=method, params=params, req_id=sub_id)
+
+    def _should_validate(self):
+        """Pick whether to validate a response, sampled at validate_rate"""
+        validate = self.validate_rate >= 1.0 or random.random() < self.validate_rate
+        with self.stats_lock:
+            self.validation_stats['validated' if validate else 'skipped'] += 1
+        return validate
+
+    def _make_resp(self, req, req_id, result, validate):
+        """Validate the result from the shim into a JSON-RPC response"""
+        if validate:
+            iface_name, func_name = req['method'].split('.')
+            self.contract.validate_response(iface_name, func_name, result)
+        return dict(jsonrpc="2.0", id=req_id, result=result)
 
-        signal.alarm(0)
+    @staticmethod
+    def _get_req_id(req):
+        if type(req) is not dict:
+            raise InvalidReqError(dict(msg="{} is not an object.".format(req)))
 
-    def _cmd_call(self, cmd):
-        log.debug('Sending cmd message - {}'.format(cmd))
-        resp = self._sub_call(cmd, [], 'shcmd')
-        log.debug("Cmd response - {}".format(resp))
+        # massage the data (if needed)
+        return add_get_id(req)
 
-    def _req_call(self, req):
+    @staticmethod
+    @contextmanager
+    def _timed(timings, phase, trace=NULL_TRACE, span=None):
+        """Add the time spent within the block to the phase, and to the trace as the given span"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            timings[phase] += end - start
+            trace.add(span or phase, start, end)
+
+    @staticmethod
+    def _record(req, resp, timings):
+        """Record the metrics of a single request"""
+        method = metrics.method_label(req)
+        metrics.requests.inc(method=method)
+        if type(resp) is dict and 'error' in resp:
+            metrics.errors.inc(method=method, code=resp['error']['code'])
+        for phase, secs in timings.items():
+            metrics.latency.observe(secs, method=method, phase=phase)
+
+    @staticmethod
+    def _error_resp(e, req_id):
+        if not isinstance(e, RpcException):
+            e = InternalError('Exception', dict(exception=repr(e)))
+        return exc_to_json_error(e, req_id)
+
+    def _req_call(self, req, worker, task_id):
         """Make RPC call for a single request"""
         req_id = None
+        timings = Counter()
+        trace = self.backend.tasks.trace(task_id)
         try:
-            if type(req) is not dict:
-                raise InvalidReqError(dict(msg="%s is not an object.".format(req)))
-
-            # massage the data (if needed)
-            req_id = add_get_id(req)
-
-            if 'jsonrpc' not in req:
-                req['jsonrpc'] = "2.0"
-            if "method" not in req:
-                raise InvalidReqError(dict(msg="No method"))
-            # return the idl - TODO - move into Scala
-            if req['method'] == "common.barrister-idl" or req['method'] == "getIdl":
+            req_id = self._get_req_id(req)
+            with self._timed(timings, 'validation', trace, 'validate_request'):
+                sub_req = self._prepare_req(req, req_id, task_id)
+            if sub_req is None:
                 return self.contract.idl_parsed
-            # add the default interface if none exists
-            if req['method'].find('.') < 0:
-                req['method'] = "{}.{}".format('Default', req['method'])
-
-            # NOTE - would setup context and run pre/post filters here in Barrister
-            # Ok, - we're good to go
-            method = req["method"]
-            iface_name, func_name = method.split('.')
-            params = req.get('params', [])
-
-            self.contract.validate_request(iface_name, func_name, params)
-            result = self._sub_call(method, params, req_id)
-            self.contract.validate_response(iface_name, func_name, result)
-            resp = dict(jsonrpc="2.0", id=req_id, result=result)
 
-        except RpcException as e:
-            resp = exc_to_json_error(e, req_id)
+            # an unvalidated result is left encoded and passed straight through into the response
+            validate = self._should_validate()
+            with self.backend.tasks.bind(sub_req['req_id'], task_id), self._timed(timings, 'shim'):
+                result = self._sub_call(sub_req, worker, self._get_timeout(sub_req['method']), trace=trace,
+                                        raw=not validate)
+            with self._timed(timings, 'validation', trace, 'validate_response'):
+                resp = self._make_resp(req, req_id, result, validate)
         except Exception as e:
-            _e = InternalError('Exception', dict(exception=repr(e)))
-            resp = exc_to_json_error(_e, req_id)
+            resp = self._error_resp(e, req_id)
+        self._record(req, resp, timings)
         return resp
 
-    def _sub_call(self, method, params, req_id):
-        """Acutal call to the shim/client subprocess"""
-        self.backend.create_request_dir(req_id)
-        # create the (sub-)req
-        sub_req = dict(method=method, params=params, req_id=req_id)
-        # blocking-wait to send the request
-        with open(REQ_FIFO, "w") as f:
-            f.write(json.dumps(sub_req))
+    def _batch_call(self, reqs, iface_name, worker, task_id):
+        """
+        Make RPC call for a batch of requests
+        The valid requests are shipped to the shim in a single message, wrapped by the
+        pre/post batch hooks of the interface, and come back in a single message
+        """
+        timings = [Counter() for _ in reqs]
+        task_resp = self._run_batch(reqs, iface_name, worker, task_id, timings)
+        for req, resp, req_timings in zip(reqs, task_resp, timings):
+            self._record(req, resp, req_timings)
+        return task_resp
+
+    def _run_batch(self, reqs, iface_name, worker, task_id, timings):
+        trace = self.backend.tasks.trace(task_id)
+        task_resp = [None] * len(reqs)
+        subs = []
+        for i, req in enumerate(reqs):
+            req_id = None
+            try:
+                req_id = self._get_req_id(req)
+                with self._timed(timings[i], 'validation', trace, 'validate_request'):
+                    sub_req = self._prepare_req(req, req_id, task_id)
+                if sub_req is None:
+                    task_resp[i] = self.contract.idl_parsed
+                else:
+                    subs.append((i, req_id, sub_req))
+            except Exception as e:
+                task_resp[i] = self._error_resp(e, req_id)
+
+        if not subs:
+            return task_resp
+
+        # the batch as a whole is given the time of all its requests, those without a timeout of their own
+        # or a global one only being bounded by the rest
+        timeouts = [t for t in (self._get_timeout(sub_req['method']) for (_, _, sub_req) in subs) if t is not None]
+        timeout = sum(timeouts) if timeouts else None
+        # the shim runs the batch as a whole, so its time is only known for the batch
+        batch_timings = Counter()
+        try:
+            with ExitStack() as stack, self._timed(batch_timings, 'shim'):
+                for (_, _, sub_req) in subs:
+                    stack.enter_context(self.backend.tasks.bind(sub_req['req_id'], task_id))
+                batch_resp = worker.call(dict(batch=[sub_req for (_, _, sub_req) in subs], iface=iface_name), timeout,
+                                         trace=trace)
+        except (futures.TimeoutError, ShimExitError) as e:
+            e = RequestTimeoutError(timeout) if isinstance(e, futures.TimeoutError) else WorkerExitError()
+            for (i, req_id, _) in subs:
+                task_resp[i] = self._error_resp(e, req_id)
+            return task_resp
+        finally:
+            metrics.latency.observe(batch_timings['shim'], method='batch', phase='shim')
+            for (_, _, sub_req) in subs:
+                self.backend.del_request_dir(sub_req['req_id'])
+
+        # a failure of the batch as a whole is reported against every request
+        sub_resps = batch_resp.get('batch', [batch_resp] * len(subs))
+        for (i, req_id, sub_req), sub_resp in zip(subs, sub_resps):
+            try:
+                result = self._check_sub_resp(sub_resp)
+                with self._timed(timings[i], 'validation', trace, 'validate_response'):
+                    task_resp[i] = self._make_resp(reqs[i], req_id, result, self._should_validate())
+            except Exception as e:
+                task_resp[i] = self._error_resp(e, req_id)
+        return task_resp
 
-        # blocking-wait to read the resp
-        with open(RESP_FIFO, "r") as f:
-            sub_resp = json.loads(f.read())
+    def _get_timeout(self, method):
+        return self.timeouts.get(method, self.timeout)
+
+    def _sub_call(self, sub_req, worker, timeout=None, cmd=False, trace=NULL_TRACE, raw=False):
+        """Acutal call to the shim/client subprocess"""
+        try:
+            sub_resp = worker.call(sub_req, timeout, cmd, trace, raw)
+        except futures.TimeoutError:
+            raise RequestTimeoutError(timeout)
+        except ShimExitError:
+            raise WorkerExitError()
+        finally:
+            self.backend.del_request_dir(sub_req['req_id'])
 
         # check the response
+        return self._check_sub_resp(sub_resp)
+
+    @staticmethod
+    def _check_sub_resp(sub_resp):
+        """Check the response from the shim, raising any error and returning the result"""
         if 'error' in sub_resp:
             error_code = sub_resp['error']
-            log.debug(sub_resp)
+            log.debug("Shim error - %s", Payload(sub_resp))
             if error_code == ERR_METHOD_NOT_FOUND:
                 raise MethodNotFoundError()
             elif error_code == ERR_INTERNAL:
@@ -242,13 +437,17 @@ class StackHutRPC:
             else:
                 raise CustomError(error_code, sub_resp['msg'], sub_resp['data'])
 
-        self.backend.del_request_dir(req_id)
-        # validate and return the response
-        result = sub_resp['result']
-        return result
+        return sub_resp['result']
+
+    def _record_queue(self, task_req):
+        """Record the time the task waited to be given a worker"""
+        waited = self.backend.tasks.age(task_req['id'])
+        metrics.latency.observe(waited, method=metrics.method_label(task_req['request']), phase='queue')
+        now = time.monotonic()
+        self.backend.tasks.trace(task_req['id']).add('queue', now - waited, now)
 
     def call(self, task_req):
-        """Make RPC call for given task"""
+        """Make RPC call for given task on the next available worker"""
         # Massage the data
         try:
             req = task_req['request']
@@ -258,18 +457,18 @@ class StackHutRPC:
 
                 # find batch interface
                 iface_name = None
-                first_method = req[0].get('method', None)
+                first_method = req[0].get('method', None) if type(req[0]) is dict else None
                 if first_method:
                     iface_name = 'Default' if first_method.find('.') < 0 else first_method.split('.')[0]
-                if iface_name:
-                    self._cmd_call('{}.{}'.format(iface_name, SHCmds.preBatch.name))
-
-                task_resp = [self._req_call(r) for r in req]
 
-                if iface_name:
-                    self._cmd_call('{}.{}'.format(iface_name, SHCmds.postBatch.name))
+                # a batch runs entirely on a single worker
+                with self.pool.worker() as worker:
+                    self._record_queue(task_req)
+                    task_resp = self._batch_call(req, iface_name, worker, task_req['id'])
             else:
-                task_resp = self._req_call(req)
+                with self.pool.worker() as worker:
+                    self._record_queue(task_req)
+                    task_resp = self._req_call(req, worker, task_req['id'])
 
         except Exception as e:
             task_resp = exc_to_json_error(InternalError(repr(e)))
@@ -13,9 +13,14 @@
 # limitations under the License.
 import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import sh
 
 from . import rpc
+from .tracing import tracer
 from .runtime_server import RuntimeServer
+from .. import utils
 from ..utils import log
 
 shim_cmds = {
@@ -39,38 +44,71 @@ class ServiceRunner:
         if self.shim_cmd is None:
             raise RuntimeError("Unknown stack - {}".format(self.hutcfg.stack))
 
-        # init the local runtime service
-        self.runtime_server = RuntimeServer(backend)
+        # concurrent node requests are told apart by AsyncLocalStorage, missing from older versions
+        if self.hutcfg.stack == 'nodejs' and self.hutcfg.concurrency > 1:
+            node = sh.Command(self.shim_cmd[0])
+            check = "process.exit(require('async_hooks').AsyncLocalStorage ? 0 : 1)"
+            try:
+                node(self.shim_cmd[1:-1] + ['-e', check])
+            except sh.ErrorReturnCode:
+                raise RuntimeError("Concurrency above 1 requires Node.js 12.17 or later")
+
+        # only the python shim can fork once the app is loaded
+        prefork = self.hutcfg.prefork and self.hutcfg.stack == 'python'
+        if self.hutcfg.prefork and not prefork:
+            log.warn("Prefork is not supported for stack {}, starting workers separately".format(self.hutcfg.stack))
+
+        if self.hutcfg.trace:
+            tracer.open(self.hutcfg.trace)
+        utils.LOG_PAYLOADS = self.hutcfg.log_payloads
+
+        # init the local runtime service, with a helper thread for each request that may be in flight
+        self.runtime_server = RuntimeServer(backend, cache_size=self.hutcfg.download_cache * 1024 * 1024,
+                                            helper_threads=self.hutcfg.workers * self.hutcfg.concurrency)
         # init the rpc server
-        self.rpc = rpc.StackHutRPC(self.backend, self.shim_cmd)
+        self.rpc = rpc.StackHutRPC(self.backend, self.shim_cmd, self.hutcfg.workers, self.hutcfg.concurrency,
+                                   self.hutcfg.validate_responses, self.runtime_server.shim_env, prefork,
+                                   self.hutcfg.timeout, self.hutcfg.timeouts)
 
         assert threading.current_thread() == threading.main_thread()
         signal.signal(signal.SIGTERM, sigterm_handler)
         signal.signal(signal.SIGINT, sigterm_handler)
 
     def __enter__(self):
+        # keep writing logs off the request threads
+        utils.start_async_logging()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """clean the system, write all output data and exit"""
         log.debug('Shutting down service runner')
+        tracer.close()
+        utils.stop_async_logging()
+
+    def _run_task(self, task_req):
+        # make the internal rpc call
+        task_resp = self.rpc.call(task_req)
+        # send the response out to the storage backend
+        self.backend.put_response(task_req['id'], task_resp)
 
     def run(self):
         # error_count = 0
 
-        # setup the run contexts
-        with self.backend, self.runtime_server, self.rpc:
+        # setup the run contexts, dispatching requests to a thread per in-flight shim request
+        max_tasks = self.hutcfg.workers * self.hutcfg.concurrency
+        with self.backend, self.runtime_server, self.rpc, ThreadPoolExecutor(max_workers=max_tasks) as executor:
+            # wait until the service has started up before taking requests
+            self.rpc.startup()
+            self.backend.set_ready()
+
             while True:
                 try:
                     # get the request
                     task_req = self.backend.get_request()
-                    # make the internal rpc call
-                    task_resp = self.rpc.call(task_req)
-                    # send the response out to the storage backend
-                    self.backend.put_response(task_resp)
+                    task = executor.submit(self._run_task, task_req)
                 except KeyboardInterrupt:
                     break
 
                 if not self.hutcfg.persistent:
+                    task.result()
                     break
-
@@ -14,43 +14,109 @@
 """
 StackHut Runtime library, accessible over JSON-RPC
 """
+import os
+import shutil
+import socket
+import resource
+import asyncio
+import tempfile
 import threading
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from urllib.parse import urlsplit
 
-import requests
 import sh
-from werkzeug.wrappers import Request, Response
-from werkzeug.serving import run_simple
 from jsonrpc import JSONRPCResponseManager, dispatcher
 
-from ..utils import log
-from . import rpc, backends
+from ..utils import log, Payload
+from . import rpc, backends, downloads
 
 backend = None
+downloader = None
+# helper connections waiting to be accepted, as asyncio's default
+LISTEN_BACKLOG = 100
 
 
 class RuntimeServer(threading.Thread):
-    def __init__(self, _backend):
+    """
+    Serves the runtime helper API to the shims, over HTTP on a private unix socket
+    The shims find the socket through the STACKHUT_RUNTIME_SOCK env var, so several
+    services may run side by side on a host
+    """
+    def __init__(self, _backend, cache_size=0, helper_threads=1):
         super().__init__(daemon=True)
-        global backend
+        global backend, downloader
         backend = _backend
-
-    @Request.application
-    def application(self, request):
-        log.debug("Got helper request - {}".format(request.data))
-        response = JSONRPCResponseManager.handle(request.data, dispatcher)
-        return Response(response.json, mimetype='application/json')
+        self.loop = asyncio.new_event_loop()
+        # helpers may block for some time, so run them on threads of their own, one per request in flight
+        self.executor = ThreadPoolExecutor(max_workers=helper_threads)
+        # keep downloads across requests if configured
+        self.cache = downloads.DownloadCache(os.path.join(backends.STACKHUT_DIR, '.cache'), cache_size) \
+            if cache_size else None
+        downloader = downloads.Downloader(self.loop, cache=self.cache)
+
+        # bind and listen now so shims may connect before the server is running, e.g. from startup hooks,
+        # and are served once it is
+        self.sock_dir = tempfile.mkdtemp(prefix='stackhut-')
+        self.sock_path = os.path.join(self.sock_dir, 'runtime.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.sock_path)
+        self.sock.listen(LISTEN_BACKLOG)
+
+    @property
+    def shim_env(self):
+        """Env vars telling the shims how to reach the server"""
+        return dict(STACKHUT_RUNTIME_SOCK=self.sock_path)
 
     def run(self):
         # start in a new thread
         log.debug("Starting StackHut helper-server")
-        run_simple('localhost', 4000, self.application, threaded=True)
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_unix_server(self.helper_server, sock=self.sock,
+                                                               backlog=LISTEN_BACKLOG))
+        self.loop.run_forever()
 
     def __enter__(self):
         self.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+        shutil.rmtree(self.sock_dir, ignore_errors=True)
+        if self.cache is not None:
+            log.debug("Download cache - {}".format(self.cache.stats))
+            self.cache.save()
+
+    async def helper_server(self, reader, writer):
+        """Serve JSON-RPC helper calls on a single (keep-alive) shim connection"""
+        try:
+            while True:
+                request = await backends.read_http_request(reader)
+                if request is None:
+                    break
+                method, path, version, headers = request
+                body = await backends.read_http_body(reader, headers)
+                log.debug("Got helper request - %s", Payload(body))
+
+                if path == '/jsonrpc':
+                    response = await self.loop.run_in_executor(self.executor, JSONRPCResponseManager.handle,
+                                                               body.decode('utf-8'), dispatcher)
+                    status, data = HTTPStatus.OK, response.json.encode('utf-8') if response else b''
+                else:
+                    status, data = HTTPStatus.NOT_FOUND, b''
+
+                conn_hdr = headers.get('connection', '').lower()
+                keep_alive = (conn_hdr != 'close') if version == 'HTTP/1.1' else (conn_hdr == 'keep-alive')
+                writer.write(backends.render_http_response(status, data, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            log.debug("Closing helper connection - {}".format(repr(e)))
+        finally:
+            writer.close()
 
 ###############################################################################
 # Runtime Functions
@@ -58,7 +124,7 @@ class RuntimeServer(threading.Thread):
 
 @dispatcher.add_method
 def get_stackhut_user(req_id):
-    auth = backend.request.get('auth', None)
+    auth = backend.get_task(req_id).get('auth', None)
     return auth['username'] if auth else ''
 
 
@@ -84,24 +150,68 @@ def get_file(req_id, key):
 
 # File upload / download helpers
 @dispatcher.add_method
-def download_file(req_id, url, fname=None):
-    """from http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py"""
-    fname = url.split('/')[-1] if fname is None else fname
-    req_fname = backends.get_req_file(req_id, fname)
+def download_file(req_id, url, fname=None, parallel=False):
+    fname = os.path.basename(urlsplit(url).path) if fname is None else fname
     log.info("Downloading file {} from {}".format(fname, url))
-    r = requests.get(url, stream=True)
-    with open(req_fname, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
+    downloader.download(url, backends.new_req_file(req_id, fname), parallel)
     return fname
 
 
 @dispatcher.add_method
-def run_command(req_id, cmd, stdin=''):
-    try:
-        cmd_run = sh.Command(cmd)
-        output = cmd_run(_in=stdin)
-    except sh.ErrorReturnCode as e:
-        raise rpc.NonZeroExitError(e.exit_code, e.stderr)
-    return output
+def download_files(req_id, urls, parallel=False):
+    """Download several files at once, each given as a url or a [url, fname] pair"""
+    items = [(u, os.path.basename(urlsplit(u).path)) if isinstance(u, str) else tuple(u) for u in urls]
+    log.info("Downloading files {}".format(', '.join(fname for (_, fname) in items)))
+    downloader.download_many([(url, backends.new_req_file(req_id, fname)) for (url, fname) in items], parallel)
+    return [fname for (_, fname) in items]
+
+
+@dispatcher.add_method
+def get_download_stats(req_id):
+    cache = downloader.cache
+    return cache.stats if cache is not None else dict(hits=0, misses=0, evictions=0, files=0, size=0)
+
+
+def limit_resources(max_memory=None, max_cpu=None):
+    """Returns a function to apply the memory (MB) and CPU time (s) limits within a child process"""
+    def preexec():
+        if max_memory:
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory * 1024 * 1024,) * 2)
+        if max_cpu:
+            resource.setrlimit(resource.RLIMIT_CPU, (max_cpu,) * 2)
+    return preexec if (max_memory or max_cpu) else None
+
+
+@dispatcher.add_method
+def run_command(req_id, cmd, stdin='', stdin_file=None, stdout_file=None, stderr_file=None,
+                timeout=None, max_memory=None, max_cpu=None):
+    """
+    Run cmd, a program name or a list of the program and its args, returning its output.
+    Input and output may instead be streamed from and to files in the request dir,
+    in which case the name of the output file is returned
+    """
+    cmd = [cmd] if isinstance(cmd, str) else cmd
+    with ExitStack() as stack:
+        def req_file(fname, mode):
+            path = backends.new_req_file(req_id, fname) if mode == 'wb' else backends.get_req_file(req_id, fname)
+            if mode == 'wb' and os.path.lexists(path):
+                # replace rather than truncate, the file may be linked elsewhere
+                os.remove(path)
+            return stack.enter_context(open(path, mode))
+
+        kwargs = dict(_in=req_file(stdin_file, 'rb') if stdin_file else stdin,
+                      _timeout=timeout, _preexec_fn=limit_resources(max_memory, max_cpu))
+        if stdout_file:
+            kwargs['_out'] = req_file(stdout_file, 'wb')
+        if stderr_file:
+            kwargs['_err'] = req_file(stderr_file, 'wb')
+
+        try:
+            output = sh.Command(cmd[0])(*cmd[1:], **kwargs)
+        except sh.TimeoutException:
+            raise rpc.CommandTimeoutError(timeout)
+        except sh.ErrorReturnCode as e:
+            # only return the tail of the error output
+            raise rpc.NonZeroExitError(e.exit_code, e.stderr[-64 * 1024:].decode('utf-8', 'replace'))
+
+    return stdout_file if stdout_file else str(output)
@@ -0,0 +1,171 @@
+# Copyright 2015 StackHut Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-request tracing, recording the time spent in each phase of a request as a JSONL trace file
+"""
+import re
+import json
+import math
+import time
+import uuid
+import threading
+from queue import Queue
+from contextlib import contextmanager
+from collections import defaultdict
+
+from ..utils import log
+
+# the phases of a request in the order they happen
+PHASES = ['http_receive', 'decode', 'queue', 'validate_request', 'shim_write', 'shim_exec', 'shim_read',
+          'validate_response', 'encode']
+# incoming trace ids, either our own header or the trace-id of a W3C traceparent
+TRACE_ID_HEADER = 'x-trace-id'
+re_traceparent = re.compile('^[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$')
+
+
+def trace_id_from(headers):
+    """The trace id carried by the request headers, or a new one"""
+    trace_id = headers.get(TRACE_ID_HEADER)
+    if trace_id:
+        return trace_id[:64]
+    m = re_traceparent.match(headers.get('traceparent', ''))
+    return m.group(1) if m else uuid.uuid4().hex
+
+
+class Trace:
+    """The spans recorded for a single request, as offsets in seconds from its start"""
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.wall_start = time.time()
+        self.start = time.monotonic()
+        self.spans = []
+
+    def __bool__(self):
+        return True
+
+    def add(self, name, start, end):
+        """Record a span between two time.monotonic() readings"""
+        self.spans.append((name, start - self.start, end - start))
+
+    @contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic())
+
+    def to_dict(self, method):
+        return dict(trace_id=self.trace_id, method=method, start=round(self.wall_start, 6),
+                    duration=round(time.monotonic() - self.start, 6),
+                    spans=[[name, round(offset, 6), round(duration, 6)] for (name, offset, duration) in self.spans])
+
+
+class NullTrace:
+    """Stands in for a Trace when tracing is off, recording nothing"""
+    trace_id = None
+
+    def __bool__(self):
+        return False
+
+    def add(self, name, start, end):
+        pass
+
+    @contextmanager
+    def span(self, name):
+        yield
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer(threading.Thread):
+    """Writes finished traces to the trace file in the background, keeping file IO off the request path"""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.fname = None
+        self.q = Queue()
+
+    @property
+    def enabled(self):
+        return self.fname is not None
+
+    def open(self, fname):
+        log.debug("Writing request traces to {}".format(fname))
+        self.fname = fname
+        self.start()
+
+    def begin(self, headers):
+        """Start a trace for a new request, continuing any trace id it was sent with"""
+        return Trace(trace_id_from(headers)) if self.enabled else NULL_TRACE
+
+    def finish(self, trace, method):
+        """Queue the finished trace of a request for the given function to be written out"""
+        if trace:
+            self.q.put(trace.to_dict(method))
+
+    def run(self):
+        with open(self.fname, 'a') as f:
+            while True:
+                record = self.q.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                # write out whatever has built up before flushing
+                if self.q.empty():
+                    f.flush()
+
+    def close(self):
+        if self.enabled:
+            self.q.put(None)
+            self.join()
+
+
+tracer = Tracer()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(lines, method=None):
+    """
+    Summarise the traces in a trace file
+    Returns the number of traces and a list of (phase, count, mean, p50, p95, p99, max) rows in seconds,
+    the total time of each request included as the last row
+    """
+    durations = defaultdict(list)
+    count = 0
+    for line in lines:
+        record = json.loads(line)
+        if method is not None and record.get('method') != method:
+            continue
+        count += 1
+        # phases seen more than once in a request, such as within a batch, are added together
+        per_phase = defaultdict(float)
+        for (name, _, duration) in record['spans']:
+            per_phase[name] += duration
+        for name, duration in per_phase.items():
+            durations[name].append(duration)
+        durations['total'].append(record['duration'])
+
+    order = PHASES + sorted(set(durations) - set(PHASES) - {'total'}) + ['total']
+    rows = []
+    for name in order:
+        values = sorted(durations.get(name, []))
+        if values:
+            rows.append((name, len(values), sum(values) / len(values), percentile(values, 50),
+                         percentile(values, 95), percentile(values, 99), values[-1]))
+    return count, rows
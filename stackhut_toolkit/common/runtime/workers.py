@@ -0,0 +1,484 @@
+# Copyright 2015 StackHut Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pool of shim/client subprocesses used by StackHutRPC to run requests
+"""
+import os
+import re
+import glob
+import socket
+import time
+import signal
+import struct
+import itertools
+import threading
+from concurrent import futures
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import sh
+
+from ..utils import log
+from . import codec
+from .tracing import NULL_TRACE
+
+# per-worker channel, the shim finds its own socket via the env
+SHIM_SOCK = '.shim.{}.sock'
+# a crashed shim is respawned after a delay, doubling on each crash in quick succession
+RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 30
+# seconds a shim must have been running for its crash not to count as quick succession
+STABLE_UPTIME = 60
+# the shims write the msg_id of a successful response first, then its result as the only other field
+re_result = re.compile(rb'\{"msg_id":(\d+),"result":')
+re_msg_id = re.compile(rb'\{"msg_id":(\d+)')
+# sys/un.h on OS X
+SOL_LOCAL = 0
+LOCAL_PEERPID = 0x002
+
+
+def cleanup_channels():
+    """Remove any sockets left behind by the shim workers"""
+    for f in glob.glob(SHIM_SOCK.format('*')):
+        os.remove(f)
+
+
+def spawn_shim(name, shim_cmd, env, on_exit=None):
+    """Start a shim/client subprocess in the background, logging its output"""
+    cmd = sh.Command(shim_cmd[0])
+    return cmd(shim_cmd[1:], _bg=True, _bg_exc=False, _env=dict(os.environ, **env),
+               _done=(lambda p, success, exit_code: on_exit(exit_code)) if on_exit else None,
+               _out=lambda x: log.debug("Runner {} - {}".format(name, x.rstrip())),
+               _err=lambda x: log.error("Runner {} - {}".format(name, x.rstrip())))
+
+
+class ShimExitError(ConnectionError):
+    """The shim exited while handling a request"""
+
+
+class ShimProcess:
+    """
+    A shim/client subprocess, respawned should it exit by itself - after a delay, doubling on
+    each crash in quick succession. on_crash is called with the exit code of every crash
+    """
+    def __init__(self, name, shim_cmd, env, on_crash=None):
+        self.name = name
+        self.shim_cmd = shim_cmd
+        self.env = env
+        self.on_crash = on_crash
+        # crashes since the shim was last up for STABLE_UPTIME
+        self.quick_crashes = 0
+        self.generation = 0
+        self.started = None
+        self.closing = False
+        self.lock = threading.Lock()
+        self.p = self._spawn()
+
+    def _spawn(self):
+        """Start a new shim process, watching for it to exit"""
+        self.generation += 1
+        generation = self.generation
+        self.started = time.monotonic()
+        return spawn_shim(self.name, self.shim_cmd, self.env, lambda exit_code: self._on_exit(generation, exit_code))
+
+    def _on_exit(self, generation, exit_code):
+        """The shim process has exited, respawning it unless it was stopped on purpose"""
+        with self.lock:
+            if self.closing or generation != self.generation:
+                return
+            if time.monotonic() - self.started > STABLE_UPTIME:
+                self.quick_crashes = 0
+            delay = min(RESPAWN_DELAY * 2 ** self.quick_crashes, MAX_RESPAWN_DELAY)
+            self.quick_crashes += 1
+
+        if self.on_crash is not None:
+            self.on_crash(exit_code)
+        if self.closing:
+            return
+        log.error("Runner {} exited with code {}, respawning in {:.1f}s".format(self.name, exit_code, delay))
+        t = threading.Timer(delay, self._respawn, args=(generation,))
+        t.daemon = True
+        t.start()
+
+    def _respawn(self, generation):
+        with self.lock:
+            if not self.closing and generation == self.generation:
+                self.p = self._spawn()
+
+    def restart(self):
+        """Kill the shim, starting a new one in its place straight away"""
+        with self.lock:
+            if self.closing:
+                return
+            try:
+                os.kill(self.p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.p = self._spawn()
+
+    def terminate(self):
+        self.closing = True
+        terminate_shim(self.p, self.name)
+
+    def kill(self):
+        self.closing = True
+        try:
+            self.p.kill()
+        except ProcessLookupError:
+            pass
+
+
+def peer_pid(conn):
+    """Pid of the process at the other end of a unix socket"""
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[0]
+    # OS X has no SO_PEERCRED, only LOCAL_PEERPID, which the socket module doesn't expose
+    return struct.unpack('i', conn.getsockopt(SOL_LOCAL, LOCAL_PEERPID, struct.calcsize('i')))[0]
+
+
+class ShimWorker:
+    """
+    A single shim/client subprocess and the private channel used to talk to it
+    The channel is a long-lived unix socket the shim connects back to on startup,
+    carrying one JSON message per line in each direction. Every message is tagged
+    with a msg_id so several requests may be in flight at once, with responses
+    matched back to their callers as they arrive in any order
+    Results wanted raw are left encoded, to be passed straight through into the response
+    A shim that stops responding is killed and a fresh one accepted on the same
+    channel, with on_start run against each new shim before it is sent requests
+    A shim that exits by itself has crashed, and is respawned after a backoff delay,
+    unless it never connected, when startup is aborted instead
+    When preforked the shim process is owned by the pool, and shim_cmd is None,
+    with the prefork parent respawning crashed shims instead
+    """
+    def __init__(self, idx, shim_cmd, concurrency=1, env=None, on_start=None):
+        self.idx = idx
+        self.sock_path = SHIM_SOCK.format(idx)
+        self.env = dict(env or {}, STACKHUT_SHIM_SOCK=self.sock_path, STACKHUT_CONCURRENCY=str(concurrency))
+        self.on_start = on_start
+        self.conn = None
+        self.pid = None
+        self.inflight = 0
+        self.restarts = 0
+        self.crashes = 0
+        self.ever_connected = False
+        self.closing = False
+        self.proc = None
+        self.start_error = None
+        self.pending = {}
+        self.msg_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.restart_lock = threading.Lock()
+        # the shim has connected, and has then been started up
+        self.connected = threading.Event()
+        self.ready = threading.Event()
+
+        # listen for the shim before starting it
+        os.remove(self.sock_path) if os.path.exists(self.sock_path) else None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.sock_path)
+        self.sock.listen(1)
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+        # run the shim
+        self.proc = ShimProcess(idx, shim_cmd, self.env, self._on_crash) if shim_cmd is not None else None
+
+    def __repr__(self):
+        return "ShimWorker({})".format(self.idx)
+
+    def _read_loop(self):
+        """Accept each shim connection in turn, dispatching responses to their waiting callers"""
+        while True:
+            try:
+                # blocking-wait for the shim to connect back once it has loaded the app
+                conn, _ = self.sock.accept()
+            except OSError:
+                # the channel has been closed down
+                break
+
+            pid = peer_pid(conn)
+            with self.lock:
+                self.conn, self.pid = conn, pid
+                self.ever_connected = True
+            self.connected.set()
+            threading.Thread(target=self._start, daemon=True).start()
+
+            try:
+                with conn.makefile('rb') as rfile:
+                    for line in rfile:
+                        received = time.monotonic()
+                        m = re_result.match(line)
+                        with self.lock:
+                            f = self.pending.get(int(m.group(1))) if m else None
+                        if f is not None and f.raw:
+                            msg_id = int(m.group(1))
+                            sub_resp = dict(result=codec.Raw(line[m.end():].rstrip()[:-1]))
+                        else:
+                            try:
+                                sub_resp = codec.loads(line)
+                                msg_id = sub_resp.pop('msg_id', None)
+                            except (ValueError, AttributeError) as e:
+                                self._bad_message(line, e)
+                                continue
+                        decoded = time.monotonic()
+                        with self.lock:
+                            if msg_id is None:
+                                # untagged error from a dying shim, fail everything in flight
+                                fs, self.pending = list(self.pending.values()), {}
+                            else:
+                                fs = [self.pending.pop(msg_id)] if msg_id in self.pending else []
+                        for f in fs:
+                            f.trace.add('shim_exec', f.sent, received)
+                            f.trace.add('shim_read', received, decoded)
+                            f.set_result(sub_resp)
+            except OSError as e:
+                log.debug("Shim worker {} channel error - {}".format(self.idx, repr(e)))
+
+            # channel closed - fail anything still waiting on it
+            with self.lock:
+                self.connected.clear()
+                self.ready.clear()
+                self.conn = None
+                pending, self.pending = self.pending, {}
+            conn.close()
+            for f in pending.values():
+                f.set_exception(ShimExitError("Shim worker {} closed its channel".format(self.idx)))
+
+            # a preforked shim can only be seen to exit by its channel closing
+            if self.proc is None and not self.closing and self.pid == pid:
+                self.crashes += 1
+                log.error("Shim worker {} (pid {}) exited".format(self.idx, pid))
+
+    def _bad_message(self, line, e):
+        """Fail just the request a message that can't be decoded was meant for, if it can be told"""
+        log.error("Shim worker {} sent an invalid message - {}".format(self.idx, repr(e)))
+        m = re_msg_id.match(line)
+        with self.lock:
+            f = self.pending.pop(int(m.group(1)), None) if m else None
+        if f is not None:
+            f.set_exception(ValueError("Invalid response from shim worker {} - {}".format(self.idx, e)))
+
+    def _start(self):
+        """Run on_start against a newly connected shim, then open it up to requests"""
+        try:
+            if self.on_start is not None:
+                self.on_start(self)
+        except Exception as e:
+            log.error("Shim worker {} failed to start - {}".format(self.idx, repr(e)))
+            self.start_error = e
+        finally:
+            self.ready.set()
+
+    def submit(self, sub_req, cmd=False, trace=NULL_TRACE, raw=False, timeout=None):
+        """
+        Send a sub-request to the shim, returning a Future for its response
+        Commands are sent as soon as the shim is connected, waiting up to timeout for it,
+        requests wait until it has started
+        """
+        if cmd:
+            if not self.connected.wait(timeout):
+                raise ConnectionError("Shim worker {} did not connect within {}s".format(self.idx, timeout))
+        else:
+            self.ready.wait()
+        f = Future()
+        f.trace = trace
+        f.raw = raw
+        with self.lock:
+            if self.conn is None:
+                raise ConnectionError("Shim worker {} is not connected".format(self.idx))
+            msg_id = next(self.msg_ids)
+            self.pending[msg_id] = f
+            f.pid = self.pid
+            start = time.monotonic()
+            try:
+                self.conn.sendall(codec.dumps(dict(sub_req, msg_id=msg_id)) + b'\n')
+            except OSError:
+                del self.pending[msg_id]
+                raise
+            f.sent = time.monotonic()
+        trace.add('shim_write', start, f.sent)
+        return f
+
+    def call(self, sub_req, timeout=None, cmd=False, trace=NULL_TRACE, raw=False):
+        """
+        Send a single sub-request to the shim and wait for its response
+        If none arrives within the timeout the shim is restarted and TimeoutError raised
+        """
+        f = self.submit(sub_req, cmd, trace, raw, timeout)
+        try:
+            return f.result(timeout)
+        except futures.TimeoutError:
+            trace.add('shim_exec', f.sent, time.monotonic())
+            self.restart(f.pid)
+            raise
+
+    def _on_crash(self, exit_code):
+        self.crashes += 1
+        if not self.ever_connected:
+            self.abort(ShimExitError("Shim worker {} exited with code {} while starting".format(self.idx, exit_code)))
+
+    def abort(self, e):
+        """Give up on starting the shim, failing startup with e"""
+        self.closing = True
+        if self.proc is not None:
+            self.proc.closing = True
+        self.start_error = e
+        self.connected.set()
+        self.ready.set()
+
+    def restart(self, pid):
+        """Kill a hung shim, starting a new one in its place unless that has already happened"""
+        with self.restart_lock:
+            if pid != self.pid or self.closing:
+                return
+            self.restarts += 1
+            self.pid = None
+            log.warn("Restarting shim worker {} (pid {})".format(self.idx, pid))
+            if self.proc is not None:
+                self.proc.restart()
+            else:
+                # a preforked shim is replaced by its parent
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def terminate(self):
+        self.closing = True
+        if self.proc is not None:
+            self.proc.terminate()
+
+    def kill(self):
+        self.closing = True
+        if self.proc is not None:
+            self.proc.kill()
+
+    def close(self):
+        with self.lock:
+            conn = self.conn
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        # wake the read loop from waiting on another shim
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        os.remove(self.sock_path) if os.path.exists(self.sock_path) else None
+
+
+def terminate_shim(p, name):
+    try:
+        p.terminate()
+        p.wait()
+    except sh.SignalException_15:
+        log.warn("RPC subprocess {} shutdown uncleanly".format(name))
+    except ProcessLookupError:
+        # already exited
+        pass
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of shim workers
+    Requests are dispatched to the least-loaded worker with spare capacity,
+    blocking until one becomes free
+    With prefork a single shim process loads the app then forks a worker onto each
+    channel, so the workers share the loaded app copy-on-write. Should this parent
+    crash its workers are killed along with it, and it is respawned - unless it never
+    got as far as starting any workers, when startup is aborted instead
+    """
+    def __init__(self, shim_cmd, size=1, concurrency=1, env=None, prefork=False, on_start=None):
+        log.debug("Starting {} {}shim worker(s) handling {} request(s) each"
+                  .format(size, 'preforked ' if prefork else '', concurrency))
+        self.concurrency = concurrency
+        self.workers = [ShimWorker(i, None if prefork else shim_cmd, concurrency, env, on_start)
+                        for i in range(size)]
+        self.cond = threading.Condition()
+
+        self.parent = None
+        if prefork:
+            socks = os.pathsep.join(w.sock_path for w in self.workers)
+            env = dict(env or {}, STACKHUT_PREFORK_SOCKS=socks, STACKHUT_CONCURRENCY=str(concurrency))
+            self.parent = ShimProcess('parent', shim_cmd, env, self._on_parent_crash)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def __iter__(self):
+        return iter(self.workers)
+
+    def _on_parent_crash(self, exit_code):
+        if not any(w.ever_connected for w in self.workers):
+            self.parent.closing = True
+            for w in self.workers:
+                w.abort(ShimExitError("Prefork parent exited with code {} while starting".format(exit_code)))
+            return
+
+        # orphaned workers would keep their channels from the workers of the new parent
+        for w in self.workers:
+            pid = w.pid
+            if pid is not None:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    @property
+    def restarts(self):
+        return sum(w.restarts for w in self.workers)
+
+    @property
+    def crashes(self):
+        return sum(w.crashes for w in self.workers)
+
+    @contextmanager
+    def worker(self):
+        """Reserve a slot on a worker for the duration of the block"""
+        with self.cond:
+            while True:
+                # steer clear of workers waiting on a new shim
+                w = min(self.workers, key=lambda x: (not x.ready.is_set(), x.inflight))
+                if w.inflight < self.concurrency:
+                    break
+                self.cond.wait()
+            w.inflight += 1
+        try:
+            yield w
+        finally:
+            with self.cond:
+                w.inflight -= 1
+                self.cond.notify()
+
+    def terminate(self):
+        for w in self.workers:
+            w.closing = True
+        # the preforked parent takes its workers down with it
+        if self.parent is not None:
+            self.parent.terminate()
+        for w in self.workers:
+            w.terminate()
+            w.close()
+
+    def kill(self):
+        for w in self.workers:
+            w.closing = True
+        if self.parent is not None:
+            self.parent.kill()
+        for w in self.workers:
+            w.kill()
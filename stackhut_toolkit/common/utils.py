@@ -14,6 +14,10 @@
 import logging
 import sys
 import os
+import json
+import zlib
+from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
 from colorlog import ColoredFormatter
 
 ####################################################################################################
@@ -34,9 +38,12 @@ def change_root_dir(dir):
 # Logging
 # LOGFILE = '.stackhut.log'
 logging.getLogger().disabled = True
-logging.getLogger('werkzeug').disabled = True
 
 log = logging.getLogger('stackhut')
+# how request/response payloads are logged - 'summary' for their size and checksum,
+# 'full', or the number of characters to truncate them to
+LOG_PAYLOADS = 'summary'
+_log_listener = None
 def setup_logging(verbose_mode):
     global VERBOSE
     global log
@@ -68,3 +75,42 @@ def setup_logging(verbose_mode):
     consoleHandler = logging.StreamHandler(stream=sys.stdout)
     consoleHandler.setFormatter(logFormatter)
     log.addHandler(consoleHandler)
+
+
+def start_async_logging():
+    """Hand log records to a background thread to output, so logging never blocks on the console"""
+    global _log_listener
+    if _log_listener is None:
+        q = Queue()
+        _log_listener = QueueListener(q, *log.handlers, respect_handler_level=True)
+        log.handlers = [QueueHandler(q)]
+        _log_listener.start()
+
+
+def stop_async_logging():
+    """Output any queued log records and return to logging directly"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        log.handlers = list(_log_listener.handlers)
+        _log_listener = None
+
+
+class Payload:
+    """
+    A request or response payload to log, as raw JSON bytes or a JSON-able object
+    Only rendered if the log record is output, according to LOG_PAYLOADS
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data if isinstance(self.data, bytes) else json.dumps(self.data, default=str).encode('utf-8')
+        if LOG_PAYLOADS == 'summary':
+            return "<{} bytes, crc32 {:08x}>".format(len(data), zlib.crc32(data))
+        text = data.decode('utf-8', errors='replace')
+        if LOG_PAYLOADS == 'full' or len(text) <= LOG_PAYLOADS:
+            return text
+        return "{}... <{} bytes>".format(text[:LOG_PAYLOADS], len(data))
@@ -16,6 +16,8 @@
 
 // any 1st & 3rd-party modules here
 let fs = require('fs');
+let net = require('net');
+let readline = require('readline');
 let path = require('path');
 let process = require('process');
 // load the app to call into
@@ -27,8 +29,17 @@ let stackhut = require('./stackhut');
 
 ///////////////////////////////////////////////////////////////////////////////
 // Utils
-const REQ_JSON = '.req.json';
-const RESP_JSON = '.resp.json';
+const SHIM_SOCK = process.env.STACKHUT_SHIM_SOCK || '.shim.sock';
+// number of requests the runner may have in flight on this shim at once
+const CONCURRENCY = parseInt(process.env.STACKHUT_CONCURRENCY || '1', 10);
+// concurrent requests can only be told apart in their helper calls on newer versions of Node.js
+if (CONCURRENCY > 1 && !stackhut.can_run_concurrently) {
+    console.error('concurrency above 1 requires Node.js 12.17 or later, running ' + process.version);
+    process.exit(1);
+}
+
+// connect back to the runner, one json message per line each way
+let conn = net.connect(SHIM_SOCK);
 
 // simple error handling
 function gen_error(code, msg, _data) {
@@ -37,20 +48,20 @@ function gen_error(code, msg, _data) {
     return { error: code, msg: msg, data: data };
 }
 
-// custom write func as bloody Node can't write to a named pipe otherwise!
-function sync_write_resp(resp) {
-    let buf = new Buffer(JSON.stringify(resp));
-    let fd = fs.openSync(RESP_JSON, 'w');
-    fs.writeSync(fd, buf, 0, buf.length, -1);
-    fs.closeSync(fd)
+function write_resp(resp, callback) {
+    conn.write(JSON.stringify(resp) + '\n', callback);
 }
 
 ///////////////////////////////////////////////////////////////////////////////
 // Main Run function
 function run(req) {
     // tell the client helper the current taskid
-    stackhut.req_id = req['req_id'];
+    return stackhut.with_req_id(req['req_id'], function() {
+        return call_method(req);
+    });
+}
 
+function call_method(req) {
     let ms = req['method'].split('.');
     let iface_name = ms[0];
     let func_name = ms[1];
@@ -84,8 +95,9 @@ function run(req) {
 process.on('uncaughtException', function(err) {
     console.log('Uncaught Exception - %s', err);
     let resp = gen_error(-32000, err.toString());
-    sync_write_resp(resp);
-    process.exit(0);
+    write_resp(resp, function() {
+        process.exit(0);
+    });
 });
 
 //process.on('SIGTERM', function() {
@@ -93,30 +105,75 @@ process.on('uncaughtException', function(err) {
 //    process.exit(0);
 //});
 
-// mutual recursion to handle processing req->resp
-// Thank god for TCO in ES6
-function process_resp(resp) {
-    process.chdir(stackhut.root_dir);
-    // save the json resp
-    sync_write_resp(resp);
-    process_req();
-}
-
-function process_req() {
-    // open the json req
-    let req = JSON.parse(fs.readFileSync(REQ_JSON, 'utf8'));
-
-    process.chdir(path.join('.stackhut', req['req_id']));
+// run a single request from within its request dir, resolving to its result or error
+function run_req(req) {
+    // the working dir can only follow the request when they run one at a time,
+    // and control messages have no request dir and run from the root
+    if (CONCURRENCY === 1 && !req['req_id'].startsWith('shcmd-')) {
+        let req_dir = path.join(stackhut.root_dir, '.stackhut', req['req_id']);
+        try {
+            fs.mkdirSync(req_dir);
+        } catch (e) {
+            if (e.code !== 'EEXIST') { throw e; }
+        }
+        process.chdir(req_dir);
+    }
 
     // run the command sync/async and then return the result or error
-    run(req)
+    return run(req)
+    .then(function(result) {
+        return { result: result };
+    }, function(err) {
+        return err;
+    })
     .then(function(resp) {
-        process_resp({ result: resp });
+        if (CONCURRENCY === 1) {
+            process.chdir(stackhut.root_dir);
+        }
+        return resp;
+    });
+}
+
+// run a batch of requests in order, wrapped by the pre/post batch hooks of the interface
+function run_batch(req) {
+    let iface_impl = app[req['iface']];
+    let hook = function(name) {
+        return (iface_impl && name in iface_impl) ? iface_impl[name]() : Promise.resolve(null);
+    };
+    let resps = [];
+
+    return req['batch'].reduce(function(prev, r) {
+        return prev.then(function() {
+            return run_req(r);
+        }).then(function(resp) {
+            resps.push(resp);
+        });
+    }, hook('preBatch'))
+    .then(function() {
+        return hook('postBatch');
     })
+    .then(function() {
+        return { batch: resps };
+    });
+}
+
+function process_req(line) {
+    // parse the json req
+    let req = JSON.parse(line);
+
+    ('batch' in req ? run_batch(req) : run_req(req))
     .catch(function(err) {
-        process_resp(err);
+        return gen_error(-32603, String(err));
+    })
+    .then(function(resp) {
+        // send the json resp, tagged to match the request - the msg_id goes first so the runner
+        // can pass a result through without decoding it
+        write_resp(Object.assign({ msg_id: req['msg_id'] }, resp));
     });
 }
 
 // start the loop
-process_req();
+readline.createInterface({ input: conn }).on('line', process_req);
+conn.on('end', function() {
+    process.exit(0);
+});
@@ -13,18 +13,46 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+let fs = require('fs');
+let http = require('http');
+let async_hooks = require('async_hooks');
+let path = require('path');
 let request = require('request');
-let url = "http://localhost:4000/jsonrpc";
+// the runtime server is reached over a unix socket, given by the StackHut runner
+let url = 'http://unix:' + process.env.STACKHUT_RUNTIME_SOCK + ':/jsonrpc';
+// reuse connections to the runtime server across calls
+let agent = new http.Agent({ keepAlive: true });
 
 let id_val = 0;
+// calls made within the same tick, sent together as a single batch
+let queued = [];
 module.exports.req_id = null;
 module.exports.root_dir = __dirname;
+// the id of the request each call is made for, followed across awaits so concurrent requests
+// keep to their own id - only available from Node.js 12.17
+let req_ctx = async_hooks.AsyncLocalStorage ? new async_hooks.AsyncLocalStorage() : null;
+module.exports.can_run_concurrently = req_ctx !== null;
+
+// run fn, and everything it goes on to call, on behalf of the request
+module.exports.with_req_id = function(req_id, fn) {
+    module.exports.req_id = req_id;
+    return req_ctx ? req_ctx.run(req_id, fn) : fn();
+};
+
+function current_req_id() {
+    let req_id = req_ctx ? req_ctx.getStore() : undefined;
+    return req_id !== undefined ? req_id : module.exports.req_id;
+}
 
 module.exports.Service = class {
     constructor() {
         // empty
     };
 
+    startup() {
+        return Promise.resolve(null);
+    };
+
     shutdown() {
         return Promise.resolve(null);
     };
@@ -48,10 +76,56 @@ module.exports.Service = class {
 
 ///////////////////////////////////////////////////////////////////////////////
 // Runtime Lib
+function post(payload, callback) {
+    request({
+        url: url,
+        method: 'POST',
+        body: payload,
+        json: true,
+        agent: agent
+        },
+        function(error, response, body) {
+            if(!error && response.statusCode >= 200 && response.statusCode < 300) {
+                callback(null, body);
+            } else {
+                callback('error: ' + (error || response.statusCode));
+            }
+        }
+    )
+}
+
+function settle(call, resp) {
+    if (resp && 'result' in resp) {
+        call.resolve(resp['result']);
+    } else {
+        call.reject(resp ? resp['error'] : 'No response to call ' + call.payload.method);
+    }
+}
+
+function flush() {
+    let calls = queued;
+    queued = [];
+
+    if (calls.length === 1) {
+        post(calls[0].payload, function(error, body) {
+            error ? calls[0].reject(error) : settle(calls[0], body);
+        });
+    } else {
+        post(calls.map(c => c.payload), function(error, body) {
+            if (error) {
+                calls.forEach(c => c.reject(error));
+            } else {
+                let by_id = new Map(body.map(r => [r.id, r]));
+                calls.forEach(c => settle(c, by_id.get(c.payload.id)));
+            }
+        });
+    }
+}
+
 function make_call(method, ...params) {
 
     //let params = [].slice.call(arguments, 1);
-    params.unshift(module.exports.req_id);
+    params.unshift(current_req_id());
 
     let payload = {
         method: method,
@@ -59,25 +133,13 @@ function make_call(method, ...params) {
         jsonrpc: '2.0',
         id: id_val
     };
+    id_val += 1;
 
     return new Promise(function(resolve, reject) {
-        request({
-            url: url,
-            method: 'POST',
-            body: payload,
-            json: true
-            },
-            function(error, response, body) {
-                if(!error && response.statusCode >= 200 && response.statusCode < 300) {
-                    id_val += 1;
-                    if ('result' in body) {
-                        resolve(body['result']);
-                    } else { reject(body['error']) }
-                } else {
-                    reject('error: '+ response.statusCode + error)
-                }
-            }
-        )
+        if (queued.length === 0) {
+            process.nextTick(flush);
+        }
+        queued.push({ payload: payload, resolve: resolve, reject: reject });
     })
 }
 
@@ -103,12 +165,36 @@ module.exports.get_file = function(key) {
     return make_call('get_file', key)
 };
 
-module.exports.download_file = function(url, fname) {
+module.exports.download_file = function(url, fname, parallel) {
     let _fname = typeof fname !== 'undefined' ? fname : null;
-    return make_call('download_file', url, _fname)
+    let _parallel = typeof parallel !== 'undefined' ? parallel : false;
+    return make_call('download_file', url, _fname, _parallel)
+};
+
+module.exports.download_files = function(urls, parallel) {
+    let _parallel = typeof parallel !== 'undefined' ? parallel : false;
+    return make_call('download_files', urls, _parallel)
+};
+
+module.exports.get_download_stats = function() {
+    return make_call('get_download_stats')
 };
 
-module.exports.run_command = function(cmd, stdin) {
+module.exports.run_command = function(cmd, stdin, options) {
     let _stdin = typeof stdin !== 'undefined' ? stdin : '';
-    return make_call('run_command', _cmd)
+    let o = options || {};
+    return make_call('run_command', cmd, _stdin, o.stdin_file || null, o.stdout_file || null,
+                     o.stderr_file || null, o.timeout || null, o.max_memory || null, o.max_cpu || null)
+};
+
+// the path of fname within the working dir of the current request, creating the dir if needed -
+// for requests running concurrently, which share the root dir as their working dir
+module.exports.req_path = function(fname) {
+    let req_dir = path.join(module.exports.root_dir, '.stackhut', current_req_id());
+    try {
+        fs.mkdirSync(req_dir);
+    } catch (e) {
+        if (e.code !== 'EEXIST') { throw e; }
+    }
+    return path.join(req_dir, fname);
 };
@@ -17,12 +17,67 @@
 Demo StackHut service
 """
 import json
+import math
 import os
 import signal
+import socket
 import sys
+import time
 import stackhut
 from app import SERVICES
 
+SHIM_SOCK = os.environ.get('STACKHUT_SHIM_SOCK', '.shim.sock')
+# when preforking, the channel of each worker to fork once the app is loaded
+PREFORK_SOCKS = [s for s in os.environ.get('STACKHUT_PREFORK_SOCKS', '').split(os.pathsep) if s]
+# set in each preforked worker, whose startup hooks have already run in the parent
+preforked = False
+# a crashed worker is re-forked after a delay, doubling on each crash in quick succession
+RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 30
+STABLE_UPTIME = 60
+# seconds between checks for exited workers while any are waiting to be re-forked
+REFORK_POLL = 0.1
+
+# use the fastest json library installed, messages are compact utf-8 json
+def dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def loads(line):
+    return json.loads(line.decode('utf-8'))
+
+try:
+    import orjson
+    # orjson can't handle integers too large for 64 bits, reading them as floats,
+    # so leave any run of 19 digits to json, as well as the NaN and Infinity it rejects
+    DIGITS = bytes(bytearray(ord('0') if chr(b) in '0123456789' else ord(' ') for b in range(256)))
+
+    def non_finite(obj):
+        if isinstance(obj, float):
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            return any(non_finite(v) for v in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return any(non_finite(v) for v in obj)
+        return False
+
+    def dumps(obj, json_dumps=dumps):
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json_dumps(obj)
+        # orjson writes NaN and Infinity as null, so leave them to json too
+        return json_dumps(obj) if b'null' in data and non_finite(obj) else data
+
+    def loads(line, json_loads=loads):
+        if b'0' * 19 not in line.translate(DIGITS):
+            try:
+                return orjson.loads(line)
+            except ValueError:
+                pass
+        return json_loads(line)
+except ImportError:
+    pass
+
 def gen_error(code, msg='', data=None):
     return dict(error=code, msg=msg, data=data)
 
@@ -36,6 +91,9 @@ def run(req):
     if iface_name in SERVICES:
         iface_impl = SERVICES[iface_name]
 
+        if preforked and func_name == 'startup':
+            return dict(result=None)
+
         try:
             func = getattr(iface_impl, func_name)
         except AttributeError:
@@ -54,32 +112,147 @@ def run(req):
     else:
         return gen_error(-32601)
 
+def run_req(req):
+    """Run a single request from within its request dir"""
+    # control messages have no request dir and run from the root
+    if not req['req_id'].startswith('shcmd-'):
+        req_dir = os.path.join(stackhut.root_dir, '.stackhut', req['req_id'])
+        os.makedirs(req_dir, exist_ok=True)
+        os.chdir(req_dir)
+
+    # run the command
+    try:
+        resp = run(req)
+    except Exception as e:
+        resp = gen_error(-32603, repr(e))
+
+    os.chdir(stackhut.root_dir)
+    return resp
+
+def run_batch(req):
+    """Run a batch of requests in order, wrapped by the pre/post batch hooks of the interface"""
+    iface_impl = SERVICES.get(req['iface'])
+    if hasattr(iface_impl, 'preBatch'):
+        iface_impl.preBatch()
+
+    resps = [run_req(r) for r in req['batch']]
+
+    if hasattr(iface_impl, 'postBatch'):
+        iface_impl.postBatch()
+    return dict(batch=resps)
+
 def sigterm_handler(signo, frame):
     print("Received shutdown signal".format(signo))
     sys.exit(0)
 
-if __name__ == "__main__":
-    signal.signal(signal.SIGTERM, sigterm_handler)
-
+def serve(sock_path):
+    """Connect back to the runner and serve requests, one json message per line each way"""
     try:
-        while True:
-            # open the input
-            with open(".req.json", "r") as f:
-                req = json.loads(f.read())
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(sock_path)
+        req_f = sock.makefile('rb')
+        resp_f = sock.makefile('wb')
 
-            os.chdir(os.path.join('.stackhut', req['req_id']))
+        for line in req_f:
+            req = loads(line)
 
-            # run the command
             try:
-                resp = run(req)
+                resp = run_batch(req) if 'batch' in req else run_req(req)
             except Exception as e:
                 resp = gen_error(-32603, repr(e))
 
-            os.chdir(stackhut.root_dir)
-
-            # save the output
-            with open(".resp.json", "w") as f:
-                f.write(json.dumps(resp))
+            # send the output, tagged to match the request - the msg_id goes first so the runner
+            # can pass a result through without decoding it
+            resp = dict(msg_id=req.get('msg_id'), **resp)
+            resp_f.write(dumps(resp) + b'\n')
+            resp_f.flush()
 
     except Exception as e:
         print(repr(e))
+
+def prefork(sock_paths):
+    """Run the startup hooks, then fork a worker onto each channel sharing the loaded app"""
+    for iface_impl in SERVICES.values():
+        if hasattr(iface_impl, 'startup'):
+            iface_impl.startup()
+
+    workers = {}
+    started = {}
+    quick_crashes = dict.fromkeys(sock_paths, 0)
+    stopping = False
+
+    def fork_worker(sock_path):
+        # don't hand any buffered output down to the worker
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                global preforked
+                preforked = True
+                signal.signal(signal.SIGTERM, sigterm_handler)
+                # the parent's connection to the runtime server is not ours to use
+                stackhut.conn = None
+                serve(sock_path)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        workers[pid] = sock_path
+        started[sock_path] = time.time()
+
+    # pass shutdown on to the workers and wait for them to finish
+    def forward_signal(signo, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signo)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    for sock_path in sock_paths:
+        fork_worker(sock_path)
+
+    # replace any worker that exits early, either killed by the runner after hanging or crashed,
+    # a crashed worker is re-forked once its own delay is up, without holding up the others
+    refork_at = {}
+    while workers or (refork_at and not stopping):
+        now = time.time()
+        for sock_path, at in list(refork_at.items()):
+            if at <= now and not stopping:
+                del refork_at[sock_path]
+                fork_worker(sock_path)
+
+        if refork_at and not stopping:
+            # poll for exits until the next worker is due
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid == 0:
+                time.sleep(max(0, min(min(refork_at.values()) - time.time(), REFORK_POLL)))
+                continue
+        else:
+            pid, status = os.wait()
+
+        sock_path = workers.pop(pid, None)
+        if sock_path is None or stopping:
+            continue
+
+        if os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL:
+            fork_worker(sock_path)
+        else:
+            if time.time() - started[sock_path] > STABLE_UPTIME:
+                quick_crashes[sock_path] = 0
+            delay = min(RESPAWN_DELAY * 2 ** quick_crashes[sock_path], MAX_RESPAWN_DELAY)
+            quick_crashes[sock_path] += 1
+            print("Worker {} exited, re-forking in {:.1f}s".format(pid, delay))
+            refork_at[sock_path] = time.time() + delay
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    if PREFORK_SOCKS:
+        prefork(PREFORK_SOCKS)
+    else:
+        serve(SHIM_SOCK)
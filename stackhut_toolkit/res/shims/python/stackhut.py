@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-import requests
 import json
 import os
+import socket
+import threading
+import http.client
 
-url = "http://localhost:4000/jsonrpc"
-headers = {'content-type': 'application/json'}
+# the runtime server is reached over a unix socket, given by the StackHut runner
+runtime_sock = os.environ.get('STACKHUT_RUNTIME_SOCK')
 
 id_val = 0
 req_id = None
@@ -26,6 +28,9 @@ class Service:
     def __init__(self):
         pass
 
+    def startup(self):
+        pass
+
     def shutdown(self):
         pass
 
@@ -49,29 +54,65 @@ class ServiceError(Exception):
 
 ###############################################################################
 # Runtime Lib
-def make_call(method, *_params):
+def _to_payload(method, params):
     global id_val
-    global req_id
-
-    params = list(_params)
-    params.insert(0, req_id)
-
     payload = {
         'method': method,
-        'params': params,
+        'params': [req_id] + list(params),
         'jsonrpc': '2.0',
         'id': id_val,
     }
-
-    response = requests.post(url, data=json.dumps(payload), headers=headers).json()
-
     id_val += 1
-
+    return payload
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket"""
+    def __init__(self, sock_path):
+        super().__init__('localhost')
+        self.sock_path = sock_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.sock_path)
+
+# a single keep-alive connection to the runtime server, reused across calls
+conn = None
+conn_lock = threading.Lock()
+
+def _post(payload):
+    global conn
+    body = json.dumps(payload).encode('utf-8')
+    with conn_lock:
+        for retry in (True, False):
+            conn = UnixHTTPConnection(runtime_sock) if conn is None else conn
+            try:
+                conn.request('POST', '/jsonrpc', body, {'Content-Type': 'application/json'})
+                return json.loads(conn.getresponse().read().decode('utf-8'))
+            except (http.client.HTTPException, ConnectionError):
+                # the server may have dropped an idle connection, try again on a fresh one
+                conn.close()
+                conn = None
+                if not retry:
+                    raise
+
+def _get_result(response):
     if 'result' in response:
         return response['result']
     else:
         raise RuntimeError(response['error'])
 
+def make_call(method, *params):
+    return _get_result(_post(_to_payload(method, params)))
+
+def make_calls(*calls):
+    """Make several calls in a single batch, each a (method, param, ...) tuple, returning their results in order"""
+    if not calls:
+        return []
+    payloads = [_to_payload(c[0], c[1:]) for c in calls]
+    by_id = {r.get('id'): r for r in _post(payloads)}
+    return [_get_result(by_id.get(p['id'], dict(error='No response to call {}'.format(p['method']))))
+            for p in payloads]
+
 # stackhut fields
 root_dir = os.getcwd()
 in_container = True if os.path.exists('/workdir') else False
@@ -92,8 +133,21 @@ def put_file(fname, make_public=True):
 def get_file(key):
     return make_call('get_file', key)
 
-def download_file(url, fname=None):
-    return make_call('download_file', url, fname)
+def download_file(url, fname=None, parallel=False):
+    return make_call('download_file', url, fname, parallel)
+
+def download_files(urls, parallel=False):
+    return make_call('download_files', urls, parallel)
+
+def get_download_stats():
+    return make_call('get_download_stats')
+
+def run_command(cmd, stdin='', stdin_file=None, stdout_file=None, stderr_file=None,
+                timeout=None, max_memory=None, max_cpu=None):
+    return make_call('run_command', cmd, stdin, stdin_file, stdout_file, stderr_file, timeout, max_memory, max_cpu)
 
-def run_command(cmd, stdin=''):
-    return make_call('run_command', cmd)
+def req_path(fname):
+    """The path of fname within the working dir of the current request, creating the dir if needed"""
+    req_dir = os.path.join(root_dir, '.stackhut', req_id)
+    os.makedirs(req_dir, exist_ok=True)
+    return os.path.join(req_dir, fname)
@@ -28,10 +28,11 @@ from prompt_toolkit import prompt
 
 from .common import utils
 from .common.utils import log
-from .common.runtime import rpc
+from .common.runtime import rpc, workers, tracing
 from .common.runtime.backends import LocalBackend
 from .common.runtime.runner import ServiceRunner
-from .common.commands import HutCmd
+from .common.commands import BaseCmd, HutCmd
+from .common.config import HutfileCfg
 from .common.exceptions import ConfigError
 from .toolkit_utils import *
 from .builder import Service, stacks, get_docker, OS_TYPE
@@ -282,10 +283,40 @@ class RunHostCmd(HutCmd, UserCmd):
         finally:
             # cleanup project directory before exit
             toolkit_stack.del_shim()
-            os.remove(rpc.REQ_FIFO) if os.path.exists(rpc.REQ_FIFO) else None
-            os.remove(rpc.RESP_FIFO) if os.path.exists(rpc.RESP_FIFO) else None
+            workers.cleanup_channels()
+
+
+class TraceCmd(BaseCmd):
+    """Summarise the request traces written by a service, found via the Hutfile unless given"""
+    name = 'trace'
+    description = "Summarise the time spent in each phase of the traced requests"
+
+    @staticmethod
+    def register(sp):
+        sp.add_argument("file", nargs='?', help="Trace file to summarise, defaults to the Hutfile trace setting")
+        sp.add_argument("--method", '-m', help="Only summarise requests for this function, e.g. Default.add")
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.fname = args.file or HutfileCfg().trace
+        self.method = args.method
+
+    def run(self):
+        if self.fname is None:
+            raise AssertionError("No trace file given, and no trace set in the Hutfile")
+
+        with open(self.fname) as f:
+            count, rows = tracing.summarize(f, self.method)
+
+        log.info("{} request(s) traced in {}".format(count, self.fname))
+        if rows:
+            log.info("{:<18}{:>8}{:>11}{:>11}{:>11}{:>11}{:>11}".format('phase (ms)', 'count', 'mean', 'p50', 'p95',
+                                                                     'p99', 'max'))
+            for (phase, n, *times) in rows:
+                log.info("{:<18}{:>8}".format(phase, n) + ''.join("{:>11.3f}".format(t * 1000) for t in times))
+        return 0
 
 
 COMMANDS = [
-    RunContainerCmd, RunCmd, RunHostCmd, TestRequestCmd,
+    RunContainerCmd, RunCmd, RunHostCmd, TestRequestCmd, TraceCmd,
 ]
@@ -2,3 +2,18 @@
 
 from .test_toolkit import *
 
+from .test_downloads import *
+
+from .test_metrics import *
+
+from .test_tracing import *
+
+from .test_codec import *
+
+from .test_validation import *
+
+from .test_workers import *
+
+from .test_backends import *
+
+from .test_rpc import *
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_backends
+----------------------------------
+
+Tests for the local backend and its request server, with a stand-in runner answering each request.
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import http.client
+from concurrent import futures
+
+from stackhut_toolkit.common.runtime import backends
+
+
+class StandInHutfile:
+    workers = 2
+    concurrency = 2
+
+    def service_short_name(self, author):
+        return "{}/demo:latest".format(author)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class LocalBackendTest(unittest.TestCase):
+    def setUp(self):
+        # the backend keeps its request dirs and results in the working dir
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.stackhut_dir, backends.STACKHUT_DIR = backends.STACKHUT_DIR, os.path.join(self.dir, '.stackhut')
+
+        self.port = free_port()
+        self.backend = backends.LocalBackend(StandInHutfile(), 'me', self.port)
+        self.backend.set_ready()
+        self.runner = threading.Thread(target=self.run_tasks, daemon=True)
+        self.runner.start()
+        while True:
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                break
+            except ConnectionError:
+                time.sleep(0.01)
+
+    def tearDown(self):
+        self.backend.req_q.put(None)
+        self.runner.join()
+        self.backend.__exit__(None, None, None)
+        backends.STACKHUT_DIR = self.stackhut_dir
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def run_tasks(self):
+        """Stand in for the service runner, answering each request with its params after sleeping for the first"""
+        def respond(task_req):
+            req = task_req['request']
+            time.sleep(req['params'][0])
+            self.backend.put_response(task_req['id'], dict(jsonrpc='2.0', id=req.get('id'), result=req['params']))
+
+        while True:
+            task_req = self.backend.get_request()
+            if task_req is None:
+                break
+            threading.Thread(target=respond, args=(task_req,), daemon=True).start()
+
+    def post(self, task_req, path='/run'):
+        conn = http.client.HTTPConnection('localhost', self.port)
+        conn.request('POST', path, json.dumps(task_req), {'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        data = resp.read()
+        conn.close()
+        return resp.status, json.loads(data.decode('utf-8')) if data else None
+
+    def test_duplicate_client_ids(self):
+        # as when replaying the test_request.json written by stackhut init
+        def post(i):
+            return self.post(dict(service='me/demo', id='fixed', request=dict(method='sleep', params=[0.3, i])))
+
+        with futures.ThreadPoolExecutor(2) as executor:
+            resps = list(executor.map(post, range(2)))
+        self.assertEqual(resps, [(200, dict(response=dict(jsonrpc='2.0', id=None, result=[0.3, i]))) for i in range(2)])
+        self.assertEqual(len(self.backend.tasks), 0)
+
+
+
+class LocalRequestServerTest(LocalBackendTest):
+    """Drives the request server over a raw socket, to check the HTTP handling of each connection"""
+    def connect(self):
+        sock = socket.create_connection(('localhost', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        return sock, sock.makefile('rb')
+
+    @staticmethod
+    def run_request(params, version='HTTP/1.1', headers=(), body=None):
+        if body is None:
+            body = json.dumps(dict(service='me/demo', request=dict(method='sleep', params=params))).encode('utf-8')
+            headers = ('Content-Length: {}'.format(len(body)),) + tuple(headers)
+        head = ['POST /run {}'.format(version), 'Host: localhost', 'Content-Type: application/json'] + list(headers)
+        return '\r\n'.join(head).encode('latin-1') + b'\r\n\r\n' + body
+
+    @staticmethod
+    def read_response(f):
+        """Read a single response, returning its status, headers and decoded body"""
+        status = int(f.readline().split()[1])
+        headers = {}
+        while True:
+            line = f.readline()
+            if line == b'\r\n':
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        body = f.read(int(headers['content-length']))
+        return status, headers, json.loads(body.decode('utf-8')) if body else None
+
+    def assertResult(self, f, params, connection='keep-alive'):
+        (status, headers, body) = self.read_response(f)
+        self.assertEqual((status, headers['connection']), (200, connection))
+        self.assertEqual(body['response']['result'], params)
+
+    def test_keep_alive(self):
+        (sock, f) = self.connect()
+        for i in range(3):
+            sock.sendall(self.run_request([0, i]))
+            self.assertResult(f, [0, i])
+        # pipelined requests are answered in turn
+        sock.sendall(self.run_request([0, 'a']) + self.run_request([0, 'b']))
+        self.assertResult(f, [0, 'a'])
+        self.assertResult(f, [0, 'b'])
+        # the connection is closed once asked
+        sock.sendall(self.run_request([0, 'c'], headers=['Connection: close']))
+        self.assertResult(f, [0, 'c'], 'close')
+        self.assertEqual(f.read(), b'')
+
+    def test_http_10(self):
+        # connections are closed after each request, unless asked to be kept alive
+        (sock, f) = self.connect()
+        sock.sendall(self.run_request([0, 1], 'HTTP/1.0', ['Connection: keep-alive']))
+        self.assertResult(f, [0, 1])
+        sock.sendall(self.run_request([0, 2], 'HTTP/1.0'))
+        self.assertResult(f, [0, 2], 'close')
+        self.assertEqual(f.read(), b'')
+
+    def test_expect_continue(self):
+        (sock, f) = self.connect()
+        req = self.run_request([0, 1], headers=['Expect: 100-continue'])
+        (head, body) = req.split(b'\r\n\r\n', 1)
+        sock.sendall(head + b'\r\n\r\n')
+        self.assertEqual((f.readline(), f.readline()), (b'HTTP/1.1 100 Continue\r\n', b'\r\n'))
+        sock.sendall(body)
+        self.assertResult(f, [0, 1])
+
+    def test_chunked(self):
+        (sock, f) = self.connect()
+        body = json.dumps(dict(service='me/demo', request=dict(method='sleep', params=[0, 1]))).encode('utf-8')
+        parts = [body[i:i + 10] for i in range(0, len(body), 10)]
+        chunked = b''.join(b'%x;ext=1\r\n%s\r\n' % (len(part), part) for part in parts)
+        # the trailers after the last chunk are skipped, leaving the connection ready for the next request
+        sock.sendall(self.run_request(None, headers=['Transfer-Encoding: chunked'],
+                                      body=chunked + b'0\r\nX-Checksum: 1\r\nX-Other: 2\r\n\r\n'))
+        self.assertResult(f, [0, 1])
+        sock.sendall(self.run_request(None, headers=['Transfer-Encoding: chunked'], body=chunked + b'0\r\n\r\n'))
+        self.assertResult(f, [0, 1])
+        sock.sendall(self.run_request([0, 2]))
+        self.assertResult(f, [0, 2])
+
+    def test_not_found(self):
+        (sock, f) = self.connect()
+        sock.sendall(b'GET /nowhere HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(self.read_response(f)[0], 404)
+        sock.sendall(b'GET /health HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(self.read_response(f)[::2], (200, dict(status='ok')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_codec
+----------------------------------
+
+Tests for the JSON codec used on the request path, with each JSON library installed.
+"""
+
+import unittest
+
+from stackhut_toolkit.common.runtime import codec
+
+
+class CodecTest(unittest.TestCase):
+    def tearDown(self):
+        codec.use(next(iter(codec.codecs)))
+
+    def test_codecs(self):
+        for name in codec.codecs:
+            codec.use(name)
+            obj = {'a': [1, 2.5, 'é', None, True], 'b': 10 ** 30}
+            data = codec.dumps(obj)
+            self.assertEqual(data, '{"a":[1,2.5,"é",null,true],"b":1000000000000000000000000000000}'.encode('utf-8'))
+            self.assertEqual(codec.loads(data), obj)
+            self.assertEqual(codec.loads(data.decode('utf-8')), obj)
+
+    def test_long_ints(self):
+        for name in codec.codecs:
+            codec.use(name)
+            self.assertEqual(codec.loads(b'[-9999999999999999999, 18446744073709551616, -1]'),
+                             [-9999999999999999999, 18446744073709551616, -1])
+
+    def test_stdlib_only_values(self):
+        for name in codec.codecs:
+            codec.use(name)
+            values = codec.loads(b'[NaN, Infinity, -Infinity, 1e400]')
+            self.assertNotEqual(values[0], values[0])
+            self.assertEqual(values[1:], [float('inf'), float('-inf'), float('inf')])
+            with self.assertRaises(ValueError):
+                codec.loads(b'[1,')
+
+    def test_non_finite_floats(self):
+        # written as the stdlib does, rather than the null some libraries write
+        for name in codec.codecs:
+            codec.use(name)
+            data = codec.dumps({'a': [float('nan'), float('inf')], 'b': {'c': float('-inf')}, 'd': None})
+            self.assertEqual(data, b'{"a":[NaN,Infinity],"b":{"c":-Infinity},"d":null}')
+
+    def test_raw(self):
+        for name in codec.codecs:
+            codec.use(name)
+            data = codec.dumps(dict(response=[dict(id=1, result=codec.Raw(b'{"x": [1, 2]}')),
+                                              dict(id=2, result=codec.Raw(b'3'))]))
+            self.assertEqual(data, b'{"response":[{"id":1,"result":{"x": [1, 2]}},{"id":2,"result":3}]}')
+
+    def test_unserializable(self):
+        with self.assertRaises(TypeError):
+            codec.dumps(dict(a=object()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_downloads
+----------------------------------
+
+Tests for the runtime download helpers, run against a local stand-in HTTP server.
+"""
+
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from stackhut_toolkit.common.runtime import downloads
+
+BLOB = bytes(range(256)) * 4096 + b'tail'
+ETAG = '"blob-1"'
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('localhost', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.flaky = True
+        # the new ETag of the file once a flaky download has been cut off, if it changes then
+        self.changed_etag = None
+        self.etag = ETAG
+
+    def handle_error(self, request, client_address):
+        # clients hanging up early are expected
+        pass
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.requests.append((self.path, self.headers.get('Range')))
+            srv.active += 1
+            srv.max_active = max(srv.max_active, srv.active)
+        try:
+            getattr(self, 'get_' + self.path.strip('/').split('?')[0], self.get_missing)()
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+    def send_blob(self, use_ranges=True, cut_at=None):
+        etag = self.server.etag
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end, status = 0, len(BLOB) - 1, 200
+        rng = self.headers.get('Range')
+        if use_ranges and rng and self.headers.get('If-Range', etag) == etag:
+            a, b = rng.split('=')[1].split('-')
+            start, end, status = int(a), int(b) if b else end, 206
+        body = BLOB[start:end + 1]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(BLOB)))
+        self.end_headers()
+        if cut_at is not None:
+            # drop the connection part way through the body
+            self.wfile.write(body[:cut_at])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def get_blob(self):
+        self.send_blob()
+
+    def get_norange(self):
+        self.send_blob(use_ranges=False)
+
+    def get_flaky(self):
+        with self.server.lock:
+            flaky, self.server.flaky = self.server.flaky, False
+        self.send_blob(cut_at=len(BLOB) // 3 if flaky else None)
+        if flaky and self.server.changed_etag:
+            self.server.etag = self.server.changed_etag
+
+    def get_slow(self):
+        time.sleep(0.2)
+        self.send_blob()
+
+    def get_chunked(self):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(BLOB), 100000):
+            chunk = BLOB[i:i + 100000]
+            self.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def get_redirect(self):
+        self.send_response(302)
+        self.send_header('Location', '/blob')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def get_missing(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = 'http://localhost:{}'.format(self.server.server_address[1])
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.downloader = downloads.Downloader(self.loop, concurrency=2)
+
+        self.dir = tempfile.mkdtemp()
+        self.min_parallel_size = downloads.MIN_PARALLEL_SIZE
+        downloads.MIN_PARALLEL_SIZE = 1024
+
+    def tearDown(self):
+        downloads.MIN_PARALLEL_SIZE = self.min_parallel_size
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def download(self, path, parallel=False):
+        fname = os.path.join(self.dir, path.strip('/'))
+        self.downloader.download(self.base + path, fname, parallel)
+        with open(fname, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        self.assertEqual(BLOB, self.download('/blob'))
+
+    def test_chunked(self):
+        self.assertEqual(BLOB, self.download('/chunked'))
+
+    def test_redirect(self):
+        self.assertEqual(BLOB, self.download('/redirect'))
+
+    def test_resume(self):
+        self.assertEqual(BLOB, self.download('/flaky'))
+        self.assertEqual([('/flaky', None), ('/flaky', 'bytes={}-'.format(len(BLOB) // 3))],
+                         self.server.requests)
+
+    def test_parallel(self):
+        self.assertEqual(BLOB, self.download('/blob', parallel=True))
+        ranges = [r for (_, r) in self.server.requests]
+        self.assertEqual('bytes=0-0', ranges[0])
+        self.assertEqual(downloads.PARALLEL_PARTS, len(ranges[1:]))
+
+    def test_parallel_without_ranges(self):
+        self.assertEqual(BLOB, self.download('/norange', parallel=True))
+
+    def test_missing(self):
+        with self.assertRaises(downloads.DownloadError):
+            self.download('/missing')
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'missing')))
+
+    def test_download_many(self):
+        items = [(self.base + '/slow', os.path.join(self.dir, 'slow{}'.format(i))) for i in range(5)]
+        self.assertEqual([f for (_, f) in items], self.downloader.download_many(items))
+        for (_, fname) in items:
+            with open(fname, 'rb') as f:
+                self.assertEqual(BLOB, f.read())
+        self.assertEqual(2, self.server.max_active)
+
+
+class DownloadCacheTest(DownloaderTest):
+    def setUp(self):
+        super().setUp()
+        self.cache = downloads.DownloadCache(os.path.join(self.dir, '.cache'), 2 * len(BLOB))
+        self.downloader.cache = self.cache
+
+    def download_to(self, path, fname):
+        fname = os.path.join(self.dir, fname)
+        self.downloader.download(self.base + path, fname)
+        with open(fname, 'rb') as f:
+            self.assertEqual(BLOB, f.read())
+        return fname
+
+    def test_hit(self):
+        first = self.download_to('/blob', 'a')
+        second = self.download_to('/blob', 'b')
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertEqual(dict(hits=1, misses=1, evictions=0, files=1, size=len(BLOB)), self.cache.stats)
+
+    def test_changed(self):
+        self.download_to('/blob', 'a')
+        self.server.etag = '"blob-2"'
+        self.download_to('/blob', 'b')
+        self.assertEqual((0, 2, 1), (self.cache.hits, self.cache.misses, len(self.cache.entries)))
+
+    def test_uncacheable(self):
+        self.download_to('/chunked', 'a')
+        self.download_to('/chunked', 'b')
+        self.assertEqual((0, 2, 0), (self.cache.hits, self.cache.misses, len(self.cache.entries)))
+
+    def test_eviction(self):
+        for path in ['/blob', '/blob?1', '/blob?2', '/blob']:
+            self.download_to(path, 'f')
+        self.assertEqual(dict(hits=0, misses=4, evictions=2, files=2, size=2 * len(BLOB)), self.cache.stats)
+
+    def test_evicted_while_revalidating(self):
+        self.cache.max_size = len(BLOB)
+        self.download_to('/slow', 'a')
+        items = [(self.base + path, os.path.join(self.dir, name)) for (path, name) in [('/slow', 'b'), ('/blob', 'c')]]
+        self.downloader.download_many(items)
+        for (_, fname) in items:
+            with open(fname, 'rb') as f:
+                self.assertEqual(BLOB, f.read())
+        self.assertEqual(dict(hits=0, misses=3, evictions=2, files=1, size=len(BLOB)), self.cache.stats)
+
+    def test_restart_drops_validator(self):
+        # the file changes once interrupted, so the resume is answered with the whole new file
+        pos = len(BLOB) // 3
+        self.server.changed_etag = '"blob-2"'
+        self.download_to('/flaky', 'a')
+        self.assertEqual([('/flaky', None), ('/flaky', 'bytes={}-'.format(pos))], self.server.requests)
+        self.assertEqual('"blob-2"', self.cache.entries[self.base + '/flaky']['validator'])
+
+    def test_saved(self):
+        self.download_to('/blob', 'a')
+        self.cache.save()
+        cache = downloads.DownloadCache(self.cache.root, self.cache.max_size)
+        self.assertEqual(self.cache.entries, cache.entries)
+
+    def test_unindexed_removed(self):
+        # files added since the index was last saved are gone once the cache is next opened
+        self.download_to('/blob', 'a')
+        self.cache.save()
+        self.download_to('/blob?1', 'b')
+        cache = downloads.DownloadCache(self.cache.root, self.cache.max_size)
+        self.assertEqual(list(cache.entries), [self.base + '/blob'])
+        key = cache.entries[self.base + '/blob']['key']
+        self.assertEqual(sorted(os.listdir(cache.root)), sorted([cache.index_file, key]))
+        self.assertEqual(cache.stats['size'], len(BLOB))
+
+    def test_stats_while_downloading(self):
+        # read from another thread, as by the runtime helpers, while the loop adds and evicts files
+        stats, done = [], threading.Event()
+
+        def read_stats():
+            while not done.is_set():
+                stats.append(self.cache.stats)
+
+        reader = threading.Thread(target=read_stats)
+        reader.start()
+        try:
+            items = [(self.base + '/blob?{}'.format(i), os.path.join(self.dir, str(i))) for i in range(8)]
+            self.downloader.download_many(items)
+        finally:
+            done.set()
+            reader.join()
+        self.assertTrue(stats)
+        self.assertTrue(all(s['size'] <= self.cache.max_size for s in stats))
+        self.assertEqual(dict(hits=0, misses=8, evictions=6, files=2, size=2 * len(BLOB)), self.cache.stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
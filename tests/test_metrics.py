@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for the Prometheus text rendering of the service metrics.
+"""
+
+import unittest
+
+from stackhut_toolkit.common.runtime import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        c = metrics.Counter('reqs_total', 'Requests', ['method', 'code'])
+        c.inc(method='Default.add', code=-32602)
+        c.inc(2, method='Default.add', code=-32602)
+        c.inc(method='say "hi"\n', code=1)
+        self.assertEqual(c.render().splitlines(), [
+            '# HELP reqs_total Requests',
+            '# TYPE reqs_total counter',
+            'reqs_total{method="Default.add",code="-32602"} 3',
+            'reqs_total{method="say \\"hi\\"\\n",code="1"} 1',
+        ])
+
+    def test_callback(self):
+        g = metrics.Gauge('in_flight', 'In flight', ['worker'], fn=lambda: {(0,): 2, (1,): 0})
+        self.assertEqual(g.render().splitlines()[2:], ['in_flight{worker="0"} 2', 'in_flight{worker="1"} 0'])
+
+    def test_histogram(self):
+        h = metrics.Histogram('lat_seconds', 'Latency', ['phase'], buckets=(0.1, 1))
+        for v in (0.05, 0.1, 0.5, 3):
+            h.observe(v, phase='shim')
+        self.assertEqual(h.render().splitlines()[2:], [
+            'lat_seconds_bucket{phase="shim",le="0.1"} 2',
+            'lat_seconds_bucket{phase="shim",le="1.0"} 3',
+            'lat_seconds_bucket{phase="shim",le="+Inf"} 4',
+            'lat_seconds_sum{phase="shim"} 3.65',
+            'lat_seconds_count{phase="shim"} 4',
+        ])
+
+    def test_method_label(self):
+        metrics.methods.update(['Default.add', 'Images.resize'])
+        self.assertEqual(metrics.method_label(dict(method='add')), 'Default.add')
+        self.assertEqual(metrics.method_label(dict(method='Images.resize')), 'Images.resize')
+        self.assertEqual(metrics.method_label(dict(method='Images.nope')), 'unknown')
+        self.assertEqual(metrics.method_label(dict()), 'unknown')
+        self.assertEqual(metrics.method_label([dict(method='add')]), 'batch')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_rpc
+----------------------------------
+
+Tests for the RPC layer, running requests and batches through the Python shim on a demo service.
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import unittest
+
+from stackhut_toolkit.toolkit_utils import get_res_path
+from stackhut_toolkit.common.runtime import rpc, backends
+
+IDL = """
+interface Default {
+    add(x int, y int) int
+    sleep(t float) float
+    fail(msg string) int
+    record(event string) []string
+    failBatches(on bool) bool
+}
+"""
+
+APP = """
+import time
+import stackhut
+
+class Default(stackhut.Service):
+    def __init__(self):
+        self.events = []
+        self.fail_batches = False
+
+    def preBatch(self):
+        if self.fail_batches:
+            raise RuntimeError('batch refused')
+        self.events.append('preBatch')
+
+    def postBatch(self):
+        self.events.append('postBatch')
+
+    def add(self, x, y):
+        return x + y
+
+    def sleep(self, t):
+        time.sleep(t)
+        return t
+
+    def fail(self, msg):
+        raise stackhut.ServiceError(msg)
+
+    def record(self, event):
+        self.events.append(event)
+        return list(self.events)
+
+    def failBatches(self, on):
+        self.fail_batches = on
+        return on
+
+SERVICES = {'Default': Default()}
+"""
+
+
+class StandInHutfile:
+    def service_short_name(self, author):
+        return "{}/demo:latest".format(author)
+
+
+class StandInBackend(backends.AbstractBackend):
+    def get_request(self):
+        return None
+
+    def put_file(self, fname, req_id='', make_public=False):
+        raise NotImplementedError()
+
+
+class StackHutRPCTest(unittest.TestCase):
+    timeout = None
+    timeouts = dict(sleep=0.5)
+
+    def setUp(self):
+        # the service, its contract and the shim channels all live in the working dir
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.stackhut_dir, backends.STACKHUT_DIR = backends.STACKHUT_DIR, os.path.join(self.dir, '.stackhut')
+        shim_dir = os.path.join(get_res_path('shims'), 'python')
+        for fname in ('runner.py', 'stackhut.py'):
+            shutil.copy(os.path.join(shim_dir, fname), fname)
+        with open(rpc.IDLFILE, 'w') as f:
+            f.write(IDL)
+        with open('app.py', 'w') as f:
+            f.write(APP)
+        rpc.generate_contract_file()
+
+        self.backend = StandInBackend(StandInHutfile(), 'me')
+        self.rpc = rpc.StackHutRPC(self.backend, [sys.executable, 'runner.py'], timeout=self.timeout,
+                                   timeouts=self.timeouts)
+        for w in self.rpc.pool:
+            w.ready.wait(5)
+
+    def tearDown(self):
+        self.rpc.__exit__(None, None, None)
+        self.backend.__exit__(None, None, None)
+        backends.STACKHUT_DIR = self.stackhut_dir
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def call(self, request):
+        task_req = dict(id=str(uuid.uuid4()), request=request)
+        self.backend.tasks.register(task_req)
+        return self.rpc.call(task_req)
+
+    def test_call(self):
+        self.assertEqual(self.call(dict(method='add', params=[1, 2], id=1)), dict(jsonrpc='2.0', id=1, result=3))
+
+    def test_batch_timeout(self):
+        # add has no timeout, which leaves the batch with that of sleep rather than none at all
+        start = time.monotonic()
+        resps = self.call([dict(method='sleep', params=[3], id=1), dict(method='add', params=[1, 1], id=2)])
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual([(r['id'], r['error']['code'], r['error']['data']) for r in resps],
+                         [(1, rpc.ERR_TIMEOUT, dict(timeout=0.5)), (2, rpc.ERR_TIMEOUT, dict(timeout=0.5))])
+
+
+    def test_batch_errors(self):
+        # each request of a batch succeeds or fails on its own
+        resps = self.call([dict(method='add', params=[1, 2], id=1), dict(method='fail', params=['no'], id=2),
+                           dict(method='add', params=[2, 3], id=3)])
+        self.assertEqual(resps[0], dict(jsonrpc='2.0', id=1, result=3))
+        self.assertEqual((resps[1]['id'], resps[1]['error']['code'], resps[1]['error']['message']),
+                         (2, rpc.ERR_SERVICE, 'Error - no'))
+        self.assertEqual(resps[2], dict(jsonrpc='2.0', id=3, result=5))
+
+    def test_batch_invalid_requests(self):
+        # invalid requests are answered without reaching the shim, and the rest of the batch still runs
+        resps = self.call([dict(method='add', params=[1, 'x'], id=1), 'add', dict(params=[], id=3),
+                           dict(method='nope', params=[], id=4), dict(method='add', params=[1, 1], id=5)])
+        self.assertEqual([(r['id'], r['error']['code']) for r in resps[:4]],
+                         [(1, rpc.ERR_INVALID_PARAMS), (None, rpc.ERR_INVALID_REQ), (3, rpc.ERR_INVALID_REQ),
+                          (4, rpc.ERR_METHOD_NOT_FOUND)])
+        self.assertEqual(resps[4], dict(jsonrpc='2.0', id=5, result=2))
+
+    def test_batch_hooks(self):
+        # the hooks run in the shim around the batch as a whole, and not around single requests
+        resps = self.call([dict(method='record', params=['a'], id=1), dict(method='record', params=['b'], id=2)])
+        self.assertEqual([r['result'] for r in resps], [['preBatch', 'a'], ['preBatch', 'a', 'b']])
+        resp = self.call(dict(method='record', params=['c'], id=3))
+        self.assertEqual(resp['result'], ['preBatch', 'a', 'b', 'postBatch', 'c'])
+
+    def test_batch_failure(self):
+        # a failure of the batch as a whole is reported against every request in it
+        self.call(dict(method='failBatches', params=[True], id=1))
+        resps = self.call([dict(method='add', params=[1, 2], id=1), dict(method='add', params=[1, 'x'], id=2),
+                           dict(method='record', params=['a'], id=3)])
+        self.assertEqual([(r['id'], r['error']['code']) for r in resps],
+                         [(1, rpc.ERR_INTERNAL), (2, rpc.ERR_INVALID_PARAMS), (3, rpc.ERR_INTERNAL)])
+        self.assertIn('batch refused', resps[0]['error']['message'])
+        self.assertEqual(resps[0]['error'], resps[2]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_tracing
+----------------------------------
+
+Tests for request trace ids and the summary of trace files.
+"""
+
+import json
+import unittest
+
+from stackhut_toolkit.common.runtime import tracing
+
+
+class TracingTest(unittest.TestCase):
+    def test_trace_id(self):
+        self.assertEqual(tracing.trace_id_from({'x-trace-id': 'abc'}), 'abc')
+        traceparent = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+        self.assertEqual(tracing.trace_id_from({'traceparent': traceparent}), '4bf92f3577b34da6a3ce929d0e0e4736')
+        self.assertEqual(len(tracing.trace_id_from({'traceparent': 'junk'})), 32)
+
+    def test_summarize(self):
+        lines = [json.dumps(dict(trace_id=str(i), method='Default.add', start=0, duration=i,
+                                 spans=[['queue', 0, i / 10], ['shim_exec', 0, 1], ['shim_exec', 1, 1]]))
+                 for i in range(1, 11)]
+        lines.append(json.dumps(dict(trace_id='b', method='batch', start=0, duration=100, spans=[])))
+
+        count, rows = tracing.summarize(lines, 'Default.add')
+        self.assertEqual(count, 10)
+        self.assertEqual([r[0] for r in rows], ['queue', 'shim_exec', 'total'])
+        # count, mean, p50, p95, p99, max
+        self.assertEqual(rows[1][1:], (10, 2, 2, 2, 2, 2))
+        self.assertEqual(rows[2][1:], (10, 5.5, 5, 10, 10, 10))
+        self.assertEqual(tracing.summarize(lines)[0], 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_validation
+----------------------------------
+
+Tests for the compiled validators of a barrister contract, checked against the messages of the original
+validation code - with elements of arrays prefixed by their index.
+"""
+
+import unittest
+
+from stackhut_toolkit.common.barrister import parse, Contract, RpcException
+
+IDL = """
+enum Colour {
+    red
+    green
+}
+
+struct Base {
+    id int
+}
+
+struct Point extends Base {
+    x float
+    y float
+    label string [optional]
+    colour Colour
+    tags []string
+    scores []float [optional]
+}
+
+interface Default {
+    add(x int, y int) int
+    mean(xs []float) float
+    flags(xs []bool) bool
+    move(p Point, c Colour) Point
+    path(ps []Point) []Point
+    maybe(s string) []int [optional]
+}
+"""
+
+POINT = dict(id=1, x=1.5, y=2, colour='red', tags=['a'])
+
+
+def without(d, key):
+    return {k: v for (k, v) in d.items() if k != key}
+
+
+class ValidationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.contract = Contract(parse(IDL, add_meta=False))
+
+    def assertRequestError(self, func, params, msg):
+        with self.assertRaises(RpcException) as cm:
+            self.contract.validate_request('Default', func, params)
+        self.assertEqual(cm.exception.msg, "Function 'Default.{}' invalid param {}".format(func, msg))
+
+    def assertResponseError(self, func, resp, msg):
+        with self.assertRaises(RpcException) as cm:
+            self.contract.validate_response('Default', func, resp)
+        self.assertEqual(cm.exception.msg, "Function 'Default.{}' invalid response: '{}'. {}".format(func, resp, msg))
+
+    def test_primitives(self):
+        self.contract.validate_request('Default', 'add', [1, 2])
+        # bools pass as ints, as they always have
+        self.contract.validate_request('Default', 'add', [True, 2])
+        self.assertRequestError('add', [1, 'x'], "'y'. 'x' is of type <class 'str'>, expected int")
+        self.assertRequestError('add', [None, 1], "'x'. Value cannot be null")
+
+    def test_primitive_arrays(self):
+        self.contract.validate_request('Default', 'mean', [[1, 2.5, True]])
+        self.contract.validate_request('Default', 'mean', [[]])
+        self.assertRequestError('mean', [[1, 2.5, 'a']], "'xs'. index 2: 'a' is of type <class 'str'>, expected float")
+        self.assertRequestError('mean', [[1, None]], "'xs'. index 1: Value cannot be null")
+        self.assertRequestError('mean', [(1, 2)], "'xs'. '(1, 2)' is of type <class 'tuple'>, expected list")
+        self.assertRequestError('flags', [[True, 1]], "'xs'. index 1: '1' is of type <class 'int'>, expected bool")
+
+    def test_large_primitive_arrays(self):
+        xs = [i / 7 for i in range(100000)]
+        self.contract.validate_request('Default', 'mean', [xs])
+        xs[-1] = '1'
+        self.assertRequestError('mean', [xs], "'xs'. index 99999: '1' is of type <class 'str'>, expected float")
+
+    def test_enums(self):
+        self.contract.validate_request('Default', 'move', [POINT, 'green'])
+        self.assertRequestError('move', [POINT, 'blue'], "'c'. 'blue' is not in enum: ['red', 'green']")
+        # unhashable values are simply not in the enum
+        self.assertRequestError('move', [POINT, [1]], "'c'. '[1]' is not in enum: ['red', 'green']")
+
+    def test_structs(self):
+        self.assertRequestError('move', [dict(POINT, colour='blue'), 'red'],
+                                "'p'. field 'colour': 'blue' is not in enum: ['red', 'green']")
+        self.assertRequestError('move', [without(POINT, 'y'), 'red'],
+                                "'p'. field 'y' missing from: {}".format(without(POINT, 'y')))
+        self.assertRequestError('move', [dict(POINT, z=1), 'red'], "'p'. field 'z' not found in struct Point")
+        self.assertRequestError('move', [[1], 'red'], "'p'. [1] is not a dict")
+
+    def test_inherited_fields(self):
+        self.assertRequestError('move', [without(POINT, 'id'), 'red'],
+                                "'p'. field 'id' missing from: {}".format(without(POINT, 'id')))
+        self.assertRequestError('move', [dict(POINT, id=1.5), 'red'],
+                                "'p'. field 'id': '1.5' is of type <class 'float'>, expected int")
+
+    def test_optional(self):
+        self.contract.validate_request('Default', 'move', [dict(POINT, label=None, scores=[1, None]), 'red'])
+        self.contract.validate_response('Default', 'maybe', None)
+        self.assertRequestError('move', [dict(POINT, label=3), 'red'],
+                                "'p'. field 'label': '3' is of type <class 'int'>, expected string")
+        self.assertRequestError('move', [dict(POINT, scores=[1, 'x']), 'red'],
+                                "'p'. field 'scores': index 1: 'x' is of type <class 'str'>, expected float")
+        self.assertRequestError('maybe', [None], "'s'. Value cannot be null")
+        self.assertResponseError('maybe', [1, '2'], "index 1: '2' is of type <class 'str'>, expected int")
+
+    def test_nested_arrays(self):
+        self.contract.validate_request('Default', 'path', [[POINT, dict(POINT, tags=[])]])
+        self.assertRequestError('move', [dict(POINT, tags=['a', 1]), 'red'],
+                                "'p'. field 'tags': index 1: '1' is of type <class 'int'>, expected string")
+        self.assertRequestError('path', [[POINT, dict(POINT, tags=None)]], "'ps'. index 1: field 'tags': Value cannot be null")
+        self.assertRequestError('path', [[POINT, POINT, dict(POINT, x='1')]],
+                                "'ps'. index 2: field 'x': '1' is of type <class 'str'>, expected float")
+        self.assertResponseError('path', [dict(POINT, colour='blue')],
+                                 "index 0: field 'colour': 'blue' is not in enum: ['red', 'green']")
+
+    def test_struct_validate(self):
+        point = self.contract.structs['Point']
+        self.assertEqual(point.validate(POINT), (True, None))
+        self.assertEqual(point.validate(dict(POINT, z=1)), (False, "field 'z' not found in struct Point"))
+
+
+if __name__ == '__main__':
+    unittest.main()
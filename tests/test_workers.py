@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+test_workers
+----------------------------------
+
+Tests for the shim worker pool, run against a stand-in shim that echoes, sleeps or crashes on request.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from concurrent import futures
+
+from stackhut_toolkit.common.runtime import workers
+
+# runs each request on its own thread, so responses may come back in any order
+STAND_IN_SHIM = """
+import os, sys, json, time, socket, threading
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.connect(os.environ['STACKHUT_SHIM_SOCK'])
+resp_f = sock.makefile('wb')
+lock = threading.Lock()
+
+def run(req):
+    if req['method'] == 'crash':
+        os._exit(3)
+    elif req['method'] == 'sleep':
+        time.sleep(req['params'][0])
+    resp = dict(msg_id=req['msg_id'], result=dict(pid=os.getpid(), params=req['params']))
+    with lock:
+        resp_f.write(json.dumps(resp).encode('utf-8') + b'\\n')
+        resp_f.flush()
+
+for line in sock.makefile('rb'):
+    threading.Thread(target=run, args=(json.loads(line.decode('utf-8')),)).start()
+"""
+
+
+def wait_for(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting on the pool")
+        time.sleep(0.01)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        # the shim channels are created in the working dir
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        with open('shim.py', 'w') as f:
+            f.write(STAND_IN_SHIM)
+        self.pool = workers.WorkerPool([sys.executable, 'shim.py'], size=2, concurrency=2)
+        for w in self.pool:
+            w.ready.wait(5)
+
+    def tearDown(self):
+        self.pool.terminate()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def call(self, method, *params, timeout=5):
+        with self.pool.worker() as w:
+            return w, w.call(dict(method=method, params=list(params), req_id='1'), timeout)
+
+    def test_call(self):
+        (w, resp) = self.call('echo', 1, 'a')
+        self.assertEqual(resp['result'], dict(pid=w.pid, params=[1, 'a']))
+        self.assertEqual((self.pool.restarts, self.pool.crashes), (0, 0))
+
+    def test_least_loaded(self):
+        with self.pool.worker() as w1, self.pool.worker() as w2, self.pool.worker() as w3:
+            self.assertIsNot(w1, w2)
+            self.assertIn(w3, (w1, w2))
+            self.assertEqual(sorted(w.inflight for w in self.pool), [1, 2])
+        self.assertEqual([w.inflight for w in self.pool], [0, 0])
+
+    def test_persistent_channel(self):
+        # every call goes over the same connection to the same shim
+        (w, resp) = self.call('echo')
+        pids = {w.call(dict(method='echo', params=[i], req_id='1'), 5)['result']['pid'] for i in range(50)}
+        self.assertEqual(pids, {resp['result']['pid']})
+        # messages are framed by line, whatever their size or content
+        big = 'line\nbreak ' * 100000
+        self.assertEqual(w.call(dict(method='echo', params=[big], req_id='2'), 5)['result']['params'], [big])
+
+    def test_concurrent_calls(self):
+        # four slots across the pool, so every call runs at once
+        with futures.ThreadPoolExecutor(4) as executor:
+            start = time.monotonic()
+            resps = list(executor.map(lambda i: self.call('sleep', 0.5, i)[1], range(4)))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([r['result']['params'] for r in resps], [[0.5, i] for i in range(4)])
+        self.assertEqual(len({r['result']['pid'] for r in resps}), 2)
+
+    def test_out_of_order(self):
+        # responses are matched back to their callers by msg_id, in whichever order they arrive
+        w = self.pool.workers[0]
+        slow = w.submit(dict(method='sleep', params=[0.5], req_id='1'))
+        fast = w.submit(dict(method='echo', params=['fast'], req_id='2'))
+        self.assertEqual(fast.result(5)['result']['params'], ['fast'])
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.result(5)['result']['params'], [0.5])
+
+    def test_timeout_restart(self):
+        (w, resp) = self.call('echo')
+        old_pid = resp['result']['pid']
+        with self.assertRaises(futures.TimeoutError):
+            w.call(dict(method='sleep', params=[30], req_id='2'), 0.2)
+
+        # the hung shim is killed and replaced straight away, which doesn't count as a crash
+        wait_for(lambda: w.ready.is_set() and w.pid not in (None, old_pid))
+        resp = w.call(dict(method='echo', params=[], req_id='3'), 5)
+        self.assertEqual(resp['result']['pid'], w.pid)
+        self.assertEqual((self.pool.restarts, self.pool.crashes), (1, 0))
+
+    def test_crash_respawn(self):
+        (w, resp) = self.call('echo')
+        old_pid = resp['result']['pid']
+        with self.assertRaises(workers.ShimExitError):
+            w.call(dict(method='crash', params=[], req_id='2'), 5)
+
+        # the shim is respawned after a short delay, and serves requests again
+        wait_for(lambda: w.crashes == 1 and w.ready.is_set())
+        resp = w.call(dict(method='echo', params=[], req_id='3'), 5)
+        self.assertNotEqual(resp['result']['pid'], old_pid)
+        self.assertEqual(resp['result']['pid'], w.pid)
+        self.assertEqual((self.pool.restarts, self.pool.crashes), (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()